@@ -171,6 +171,9 @@ class Preprocess:
         """
         subj = MeldSubject(subject, cohort=self.cohort)
         subject_data = []
+        if distance_maps:
+            # look up lesional hemisphere once for both hemispheres
+            lesion_hemi = subj.get_lesion_hemisphere()
         # load data & lesion
         for hemi in ("lh", "rh"):
             vals_array, lesion = subj.load_feature_lesion_data(features, hemi=hemi)
@@ -178,22 +181,22 @@ class Preprocess:
             # z-score data
             if self.params["zscore"]:
                 if hemi == "lh":
-                    self.log.info(f"Z-scoring data for {subject}")
+                    self.log.info("Z-scoring data for %s", subject)
                 vals_array = self.zscore_data(vals_array.T, features).T
             if distance_maps:
-                gdist = self.load_distances(subj, hemi)
+                gdist = self.load_distances(subj, hemi, lesion_hemi=lesion_hemi)
                 subject_data_dict["distances"] = gdist
             if self.params["scaling"] is not None:
-                self.log.info(f"Scaling data for has been removed. REIMPLEMENT")
+                self.log.info("Scaling data for has been removed. REIMPLEMENT")
             if lobes:
                 # replace lesion data with lobes task if required
                 lesion = self.lobes
             # add lesion bias
             if lesion_bias:
-                self.log.info(f"WARNING: Adding lesion bias of {lesion_bias} to {subject}")
+                self.log.info("WARNING: Adding lesion bias of %s to %s", lesion_bias, subject)
                 vals_array[lesion == 1] += lesion_bias
             if combine_hemis is not None:
-                self.log.info(f"WARNING: Combine_hemis is not implemented.")
+                self.log.info("WARNING: Combine_hemis is not implemented.")
 
             subject_data_dict["features"] = vals_array
             subject_data_dict["labels"] = lesion
@@ -201,15 +204,20 @@ class Preprocess:
             subject_data.append(subject_data_dict)
         return subject_data
 
-    def load_distances(self, subj, hemi="lh"):
-        """load geodesic distance from lesion or 300s"""
-        if (not subj.is_patient) or (subj.get_lesion_hemisphere() != hemi):
-            gdist = np.ones(NVERT, dtype=np.float32) * 300
+    def load_distances(self, subj, hemi="lh", lesion_hemi="unknown"):
+        """load geodesic distance from lesion or 300s
+
+        lesion_hemi: result of subj.get_lesion_hemisphere() if already known, to avoid looking it up again.
+        """
+        if lesion_hemi == "unknown":
+            lesion_hemi = subj.get_lesion_hemisphere()
+        if (not subj.is_patient) or (lesion_hemi != hemi):
+            gdist = np.full(NVERT, 300, dtype=np.float32)
 
         else:
-            gdist = subj.load_feature_values(".on_lh.boundary_zone.mgh", hemi=hemi)
+            gdist = np.asarray(subj.load_feature_values(".on_lh.boundary_zone.mgh", hemi=hemi), dtype=np.float32)
             # threshold to range 0,300
-            gdist = np.clip(gdist, 0, 300)
+            np.clip(gdist, 0, 300, out=gdist)
         return gdist
 
     def load_z_params(self, file="data/feature_means.json"):
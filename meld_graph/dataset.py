@@ -1,6 +1,6 @@
 import torch_geometric.data
 from meld_graph.data_preprocessing import Preprocess
-from meld_graph.icospheres import IcoSpheres
+from meld_graph.icospheres import shared_icospheres
 from meld_graph.graph_tools import GraphTools
 
 from meld_graph.models import HexPool
@@ -8,6 +8,10 @@ from meld_graph.augment import Augment
 import numpy as np
 import torch
 import logging
+import os
+import shutil
+import tempfile
+import weakref
 
 
 class Oversampler(torch.utils.data.Sampler):
@@ -22,6 +26,7 @@ class Oversampler(torch.utils.data.Sampler):
         self.log = logging.getLogger(__name__)
         self.data_source = data_source
         self._num_samples = None
+        self._lesional_ids = None
 
         if not isinstance(self.num_samples, int) or self.num_samples <= 0:
             raise ValueError(
@@ -39,9 +44,12 @@ class Oversampler(torch.utils.data.Sampler):
         Return list of len num_samples, containing data_source idxs to sample.
         Call once per epoch (when restarting iterator).
         """
-        n_non = len(self.data_source.lesional_idxs) * 2
-        non_ids = torch.randperm(len(self.data_source), dtype=torch.int64)[:n_non]
-        ids_to_choose = torch.hstack([torch.from_numpy(self.data_source.lesional_idxs), non_ids])
+        if self._lesional_ids is None:
+            self._lesional_ids = torch.as_tensor(self.data_source.lesional_idxs, dtype=torch.int64)
+        n_non = len(self._lesional_ids) * 2
+        # draw random (non-lesional or lesional) ids without building a full permutation of the dataset
+        non_ids = torch.randint(0, len(self.data_source), (n_non,), dtype=torch.int64)
+        ids_to_choose = torch.cat([self._lesional_ids, non_ids])
         return ids_to_choose[torch.randperm(len(ids_to_choose), dtype=torch.int64)]
 
     def __iter__(self):
@@ -70,6 +78,11 @@ class GraphDataset(torch_geometric.data.Dataset):
             will be available as self.get().output_level<level>.
             Distance maps will be available as self.get().output_level<level>_distance_map.
         distance_mask_medial_wall (bool): mask of medial wall in distance maps to 300.
+
+    With params["lazy_loading"], preprocessed data is saved to params["cache_dir"]
+    (default: the system temporary directory) and memory-mapped when accessed, instead of kept in memory.
+    The data is written to a meld_graph_<mode>_* directory that is removed when the dataset is garbage collected
+    or the interpreter exits. Directories of killed runs are not removed and can be deleted manually.
     """
 
     def __init__(
@@ -92,7 +105,7 @@ class GraphDataset(torch_geometric.data.Dataset):
         self.cohort = cohort
         self.mode = mode
         self.output_levels = sorted(output_levels)
-        self.icospheres = IcoSpheres()
+        self.icospheres = shared_icospheres()
         self.gt = GraphTools(
             self.icospheres,
             cohort=self.cohort,
@@ -111,13 +124,27 @@ class GraphDataset(torch_geometric.data.Dataset):
 
         # preload data in memory, with all preprocessing done
         self.data_list = []
+        # whether each data_list entry contains a lesion, filled in alongside data_list
+        self._has_lesion = []
+        # lazy_loading: save preprocessed data to cache_dir and read it in get() instead of keeping it in memory
+        self.lazy_loading = self.params.get("lazy_loading", False)
+        if self.lazy_loading:
+            cache_dir = self.params.get("cache_dir") or tempfile.gettempdir()
+            os.makedirs(cache_dir, exist_ok=True)
+            # unique directory for this dataset, removed when the dataset is deleted or at exit
+            self.cache_dir = tempfile.mkdtemp(prefix=f"meld_graph_{mode}_", dir=cache_dir)
+            weakref.finalize(self, shutil.rmtree, self.cache_dir, ignore_errors=True)
+        # when data is returned unchanged, tensors (x, y, distance_map) are created once at load time
+        self.tensor_list = None
+        if self.augment is None and not self.params.get("synth_on_the_fly", False) and not self.lazy_loading:
+            self.tensor_list = []
         self.prep = Preprocess(
             cohort=self.cohort,
             params=self.params["preprocessing_parameters"],
             icospheres=self.icospheres,
         )
         self.log.info(f"Loading and preprocessing {mode} data")
-        self.log.debug(f"Combine hemis {self.params['combine_hemis']}")
+        self.log.debug("Combine hemis %s", self.params["combine_hemis"])
 
         if self.params["synthetic_data"]["run_synthetic"]:
             self.n_subs_split_i = self.params["synthetic_data"]["n_subs"] // self.params["number_of_folds"]
@@ -134,7 +161,7 @@ class GraphDataset(torch_geometric.data.Dataset):
                 self.log.info(f"WARNING: Simulating {len(self.subject_ids)} subjects")
                 for s in np.arange(self.n_subs_split):
                     synth_sub_data_list = self.synthetic_lesion()
-                    self.data_list.extend(synth_sub_data_list)
+                    self.extend_data_list(synth_sub_data_list)
                 return
             # undersample subject ids to get controlled number
             n_subs_before = len(self.subject_ids)
@@ -150,7 +177,7 @@ class GraphDataset(torch_geometric.data.Dataset):
         for s_i, subj_id in enumerate(self.subject_ids):
             # load in (control) data
             # features are appended to list in order: left, right
-            print(subj_id)
+            self.log.debug("Loading %s", subj_id)
             subject_data_list = self.prep.get_data_preprocessed(
                 subject=subj_id,
                 features=params["features"],
@@ -166,11 +193,14 @@ class GraphDataset(torch_geometric.data.Dataset):
                     synth_sub_data_list = self.synthetic_lesion(subject_data_list)
                     # computing dists and smoothed labels
                     synth_sub_data_list = self.add_smooth_label_and_dists(synth_sub_data_list)
-                    self.data_list.extend(synth_sub_data_list)
+                    self.extend_data_list(synth_sub_data_list)
             else:
                 # add dists and smoothed labels
                 subject_data_list = self.add_smooth_label_and_dists(subject_data_list)
-                self.data_list.extend(subject_data_list)
+                self.extend_data_list(subject_data_list)
+
+        if self.tensor_list is not None:
+            self.pack_tensors()
 
         # dataset has weird properties. subject_ids needs to be the right length, matching the data length
         if self.params["synthetic_data"]["run_synthetic"]:
@@ -206,6 +236,101 @@ class GraphDataset(torch_geometric.data.Dataset):
             distance_mask_medial_wall=experiment.data_parameters.get("distance_mask_medial_wall", False),
         )
 
+    def extend_data_list(self, subject_data_list):
+        """Add hemisphere data dicts to data_list, keeping track of which ones are lesional."""
+        for sdl in subject_data_list:
+            # store C-contiguous arrays with the dtypes used for the tensors
+            sdl["features"] = np.ascontiguousarray(sdl["features"], dtype=np.float32)
+            sdl["labels"] = np.ascontiguousarray(sdl["labels"], dtype=np.int64)
+        self._has_lesion.extend(bool(np.any(sdl["labels"])) for sdl in subject_data_list)
+        if self.tensor_list is not None:
+            self.tensor_list.extend(self.to_tensors(sdl) for sdl in subject_data_list)
+        if self.lazy_loading:
+            subject_data_list = [
+                self.save_to_cache(len(self.data_list) + i, sdl) for i, sdl in enumerate(subject_data_list)
+            ]
+        self.data_list.extend(subject_data_list)
+
+    def save_to_cache(self, idx, sdl):
+        """Save arrays of a data dict to .npy files in self.cache_dir, and return dict of file paths."""
+        paths = {}
+        for key, value in sdl.items():
+            paths[key] = os.path.join(self.cache_dir, f"{idx}_{key}.npy")
+            np.save(paths[key], value)
+        return paths
+
+    def load_from_cache(self, paths):
+        """Memory-map the arrays saved with save_to_cache.
+
+        Arrays are opened copy-on-write, so augmentations do not change the cached data.
+        """
+        return {key: np.load(path, mmap_mode="c") for key, path in paths.items()}
+
+    def to_tensors(self, sdl):
+        """Convert features, labels and clipped distances of a data dict to tensors.
+
+        Also pools labels and distances to the output levels, as they do not change between epochs.
+        """
+        x = torch.from_numpy(sdl["features"])
+        y = torch.from_numpy(sdl["labels"])
+        distance_map = None
+        if "distances" in sdl:
+            distance_map = torch.from_numpy(np.clip(sdl["distances"], 0, 300).astype(np.float32))
+        output_levels = self.pool_output_levels(y, distance_map)
+        return x, y, distance_map, output_levels
+
+    def pack_tensors(self):
+        """Pack features, labels and distance maps of all hemispheres into one contiguous tensor each.
+
+        Hemispheres are copied into the packed tensors one at a time and their entries in tensor_list
+        and data_list are replaced by views into the packed tensors, so the per-hemisphere arrays are freed
+        while packing. data_list distances become the clipped distance maps used by the model.
+        """
+        if len(self.tensor_list) == 0 or any(t[2] is None for t in self.tensor_list):
+            return
+        x_0, y_0, distance_map_0, _ = self.tensor_list[0]
+        n_hemis = len(self.tensor_list)
+        x_all = torch.empty((n_hemis,) + tuple(x_0.shape), dtype=x_0.dtype)
+        y_all = torch.empty((n_hemis,) + tuple(y_0.shape), dtype=y_0.dtype)
+        distance_map_all = torch.empty((n_hemis,) + tuple(distance_map_0.shape), dtype=distance_map_0.dtype)
+        del x_0, y_0, distance_map_0
+        for i, sdl in enumerate(self.data_list):
+            x, y, distance_map, output_levels = self.tensor_list[i]
+            x_all[i] = x
+            y_all[i] = y
+            distance_map_all[i] = distance_map
+            sdl["features"] = x_all[i].numpy()
+            sdl["labels"] = y_all[i].numpy()
+            sdl["distances"] = distance_map_all[i].numpy()
+            # pooled distance maps are prefixes of the full distance map
+            for key, value in output_levels.items():
+                if key.endswith("_distance_map"):
+                    output_levels[key] = distance_map_all[i][: len(value)]
+            self.tensor_list[i] = (x_all[i], y_all[i], distance_map_all[i], output_levels)
+            del x, y, distance_map
+
+    def pool_output_levels(self, y, distance_map):
+        """Pool labels and distance map to self.output_levels.
+
+        Returns:
+            dict with attributes output_level<level> and output_level<level>_distance_map.
+        """
+        pooled = {}
+        if len(self.output_levels) == 0:
+            return pooled
+        labels_pooled = {7: y}
+        for level in range(min(self.output_levels), 7)[::-1]:
+            labels_pooled[level] = self.pool_layers[level](labels_pooled[level + 1])
+        for level in self.output_levels:
+            pooled[f"output_level{level}"] = labels_pooled[level]
+        if distance_map is not None:
+            # center pooling keeps the first vertices of the finer level, so all levels are prefixes of
+            # the (already clipped) distance map and can be taken directly without pooling level by level
+            for level in self.output_levels:
+                n_vert_level = len(self.pool_layers[level].neigh_indices)
+                pooled[f"output_level{level}_distance_map"] = distance_map[:n_vert_level]
+        return pooled
+
     def add_smooth_label_and_dists(self, subject_data_list):
         """Compute a smoothed label and distance map.
 
@@ -229,15 +354,18 @@ class GraphDataset(torch_geometric.data.Dataset):
 
     def synthetic_lesion(self, subject_data_list=[{"features": None}, {"features": None}]):
         """Add synthetic lesion to input features for both hemis"""
+        coords = self.icospheres.icospheres[7]["coords"]
+        n_features = len(self.params["features"])
+        synth_params = self.params["synthetic_data"]
+        # draw histological subtypes for all hemispheres at once
+        subtypes = np.random.choice(synth_params["n_subtypes"], size=len(subject_data_list))
         synth_dicts = []
-        for si, sdl in enumerate(subject_data_list):
-            # controls the proportion of examples with lesions.
-            subtype = np.random.choice(self.params["synthetic_data"]["n_subtypes"])
+        for sdl, subtype in zip(subject_data_list, subtypes):
             synth_dict = self.prep.generate_synthetic_data(
-                self.icospheres.icospheres[7]["coords"],
-                len(self.params["features"]),
+                coords,
+                n_features,
                 histo_type_seed=subtype,
-                synth_params=self.params["synthetic_data"],
+                synth_params=synth_params,
                 features=sdl["features"],
             )
             synth_dicts.append(synth_dict)
@@ -254,6 +382,14 @@ class GraphDataset(torch_geometric.data.Dataset):
         Returns data will have attributes x, y, distance_map, output_level<level>, output_level<level>_distance_map.
         """
         subject_data_dict = self.data_list[idx]
+        if self.lazy_loading:
+            subject_data_dict = self.load_from_cache(subject_data_dict)
+
+        if self.tensor_list is not None:
+            # no augmentation, use tensors created at load time
+            x, y, distance_map, output_levels = self.tensor_list[idx]
+            data = torch_geometric.data.Data(x=x, y=y, num_nodes=len(x))
+            return self.add_data_attributes(data, subject_data_dict, distance_map, output_levels)
 
         #could consider adding synthetic lesions to control data here
         
@@ -287,34 +423,24 @@ class GraphDataset(torch_geometric.data.Dataset):
                 num_nodes=len(subject_data_dict["features"]),
             )
 
-        # add extra output levels to data
-        if len(self.output_levels) != 0:
-            labels_pooled = {7: data.y}
-            for level in range(min(self.output_levels), 7)[::-1]:
-                labels_pooled[level] = self.pool_layers[level](labels_pooled[level + 1])
-            for level in self.output_levels:
-                setattr(data, f"output_level{level}", labels_pooled[level])
+        # clip distances
+        distance_map = torch.tensor(np.clip(subject_data_dict['distances'], 0, 300), dtype=torch.float32)
+        output_levels = self.pool_output_levels(data.y, distance_map)
+        return self.add_data_attributes(data, subject_data_dict, distance_map, output_levels)
 
+    def add_data_attributes(self, data, subject_data_dict, distance_map, output_levels):
+        """Add distance maps, object detection labels and extra output levels to data."""
         # add  distance maps
-        # clip distances
-        setattr(data, "distance_map", torch.tensor(np.clip(subject_data_dict['distances'], 0, 300), dtype=torch.float32))
+        setattr(data, "distance_map", distance_map)
 
         #add object detection labels here
         if self.params.get('object_detection',False):
             self.add_object_detection(subject_data_dict)
             setattr(data, "xyzr", torch.tensor(subject_data_dict['xyzr'], dtype=torch.float32))
-        
 
-        if len(self.output_levels) != 0:
-            dists_pooled = {7: data.distance_map}
-            for level in range(min(self.output_levels), 7)[::-1]:
-                dists_pooled[level] = self.pool_layers[level](dists_pooled[level + 1], center_pool=True)
-            for level in self.output_levels:
-                setattr(
-                    data,
-                    f"output_level{level}_distance_map",
-                    torch.clip(dists_pooled[level], 0, 300),
-                )
+        # add extra output levels to data
+        for key, value in output_levels.items():
+            setattr(data, key, value)
         return data
     
     def add_object_detection(self,data_dict):
@@ -337,10 +463,6 @@ class GraphDataset(torch_geometric.data.Dataset):
     def lesional_idxs(self):
         """find ids of data entries with lesional examples"""
         if self._lesional_idxs is None:
-            lesional_idxs = []
-            for i, d in enumerate(self.data_list):
-                if d["labels"].sum():
-                    lesional_idxs.append(i)
-            self._lesional_idxs = np.array(lesional_idxs)
+            self._lesional_idxs = np.flatnonzero(np.asarray(self._has_lesion, dtype=bool))
         return self._lesional_idxs
 
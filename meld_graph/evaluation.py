@@ -1,5 +1,10 @@
 import logging
 import os
+import concurrent.futures
+import contextlib
+import functools
+import multiprocessing
+import time
 import torch
 import torch_geometric.data
 from meld_graph.dataset import GraphDataset
@@ -7,17 +12,27 @@ from meld_graph.models import PredictionForSaliency
 import numpy as np
 import h5py
 import scipy
+import scipy.stats
 import json
+import pickle
 import pandas as pd
-from meld_graph.training import tp_fp_fn_tn, dice_coeff
+from meld_graph.icospheres import shared_icospheres
+from meld_graph.paths import MELD_PARAMS_PATH
 import os
 import numpy as np
 import h5py
 import matplotlib.pyplot as plt
+from matplotlib.gridspec import GridSpec
+from PIL import Image
 import sklearn.metrics as metrics
 import itertools
 import seaborn as sns
-from meld_graph.paths import MELD_DATA_PATH
+
+# for locking the predictions file - not available on windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # for saliency - do not force people to have this
 try:
@@ -26,6 +41,20 @@ try:
 except ImportError:
     print("NOTE: captum not found. You will not be able to compute saliency.")
 
+# for plotting surfaces - not needed for predicting and thresholding
+try:
+    import nibabel as nb
+    import matplotlib_surface_plotting.matplotlib_surface_plotting as msp
+    from meld_graph.meld_plotting import trim
+except ImportError:
+    print("NOTE: nibabel or matplotlib_surface_plotting not found. You will not be able to plot predictions.")
+
+# chunk cache size of the predictions hdf5 file, large enough to hold a whole-hemisphere saliency chunk
+PREDICTION_CHUNK_CACHE_NBYTES = 64 * 1024 * 1024
+# number of chunk cache hash slots, a prime well above the number of chunks that fit in the cache
+PREDICTION_CHUNK_CACHE_NSLOTS = 8191
+# attempts to open the predictions file for writing while another process (e.g. a reader) has it open
+PREDICTION_FILE_OPEN_ATTEMPTS = 30
 
 
 class Evaluator:
@@ -67,7 +96,10 @@ class Evaluator:
         self.saliency = saliency
         self.data_dictionary = None
         self._roc_dictionary = None
+        # features and labels of the most recently loaded subject, see _load_subject_features
+        self._subject_features_cache = {}
         self.model_name = model_name+'.pt'
+        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         # Initialised directory to save results and plots
         if save_dir is None:
             self.save_dir = self.experiment.experiment_path
@@ -177,17 +209,19 @@ class Evaluator:
             return os.path.join(experiment_path, self.model_name)
         return None
         
-    def enable_mc_dropout(self, p, n=100):
+    def enable_mc_dropout(self, p, n=100, batch_size=10):
         """
         Set parameters to do MC dropout on input data when predicting.
         Has an effect on the prediction (load_predict_data) and on all functions saving / reading data,
         which will use an additional suffix "_dropout" to write/read paths. 
+        batch_size dropout samples are predicted together in one forward pass.
         """
         self.dropout=True
         self.dropout_p = p
         self.dropout_n = n
+        self.dropout_batch_size = batch_size
         self.dropout_suffix = f"_dropout{self.dropout_p:.1f}"
-        self.log.info(f"Predicting model with droput (p={self.dropout_p}, n={self.dropout_n})")
+        self.log.info(f"Predicting model with dropout (p={self.dropout_p}, n={self.dropout_n})")
         
     def disable_mc_dropout(self):
         self.dropout = False
@@ -221,114 +255,142 @@ class Evaluator:
         roc_curves_thresholds=np.linspace(0, 1, 51),
         save_prediction=True,
         save_prediction_suffix="",
+        num_workers=0,
+        compile_model=False,
+        save_every=20,
     ):
         """
         Args:
             save_prediction (bool): save predictions to EXPERIMENT_FOLDER/results/predictions{save_prediction_suffix}.hdf5
             save_prediction_suffix (str): suffix for predictions file.
+            save_every (int): number of subjects whose predictions are kept in memory before writing them
+                to the predictions file in one go.
+            compile_model (bool): predict with a torch.compile'd model. Requires torch>=2.0, otherwise
+                the model is used as is.
+            num_workers (int): number of DataLoader workers preparing data while the model predicts.
+                Defaults to 0, loading data in the main process. Workers share batches through /dev/shm,
+                which is small in docker containers by default. Scripts using workers need to be run
+                from an `if __name__ == "__main__"` block on platforms that spawn subprocesses.
         """
 
         self.log.info("loading data and predicting model")
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        device = self.device
         #quick fix for bug if not doing dropout
         self.dropout_suffix=""
         save_prediction_suffix = f"{save_prediction_suffix}{self.dropout_suffix}"
         # predict on data
-        # TODO: enable batch_size > 1
         if self.dataset==None:
             self.dataset = GraphDataset(self.subject_ids, self.cohort, self.experiment.data_parameters, mode=self.mode)
+        loader_kwargs = {}
+        if num_workers:
+            loader_kwargs = {"num_workers": num_workers, "prefetch_factor": 4}
+        # batch both hemispheres of a subject to predict them in one forward pass
         data_loader = torch_geometric.loader.DataLoader(
             self.dataset,
             shuffle=False,
-            batch_size=1,
+            batch_size=2,
+            pin_memory=torch.cuda.is_available(),
+            **loader_kwargs,
         )
+        self.experiment.model.eval()
+        model = self.experiment.model
+        if compile_model:
+            if hasattr(torch, "compile"):
+                model = torch.compile(model)
+            else:
+                self.log.warning("torch.compile is not available in torch %s, predicting with eager model", torch.__version__)
         self.data_dictionary = {}
         store_sub_aucs = True
         self.subject_aucs = {}
-        for i, data in enumerate(data_loader):
-            self.log.debug(i)
-            subject_index = i // 2
-            hemi = ["lh", "rh"][i % 2]
-            if hemi == "lh":
-                prediction_array = []
-                distance_map_array = []
-                labels_array = []
-                features_array = []
-                geodesic_array = []
-                saliency_array = []
-            subj_id = self.subject_ids[subject_index]
-            data = data.to(device)
-            labels = data.y.squeeze()
-            geo_distance = data.distance_map
-            distance_regression_flag = "distance_regression" in self.experiment.network_parameters["training_parameters"]["loss_dictionary"].keys()
-            if self.dropout:
-                list_prediction = []
-                list_distance_map = []
-                for _ in range(self.dropout_n):
-                    mask = torch.tensor(np.random.choice([0,1],data.x.shape, p=[self.dropout_p,1-self.dropout_p]), dtype=torch.bool)
-                    x = torch.clone(data.x)
-                    x[mask] = 0
-                    estimates = self.experiment.model(x)
-                    list_prediction.append(torch.exp(estimates["log_softmax"])[:, 1].detach().cpu())
-                    # if distance_regression_flag:
-                    list_distance_map.append(estimates["non_lesion_logits"][:, 0].detach().cpu())
-                prediction = torch.mean(torch.stack(list_prediction), axis=0)
-                # if distance_regression_flag:
-                distance_map = torch.mean(torch.stack(list_distance_map), axis=0)
-                # else:
-                    # distance_map = torch.full((len(prediction), 1), torch.nan)[:, 0]
-            else:
-                estimates = self.experiment.model(data.x)
-                prediction = torch.exp(estimates["log_softmax"])[:, 1].detach().cpu()
-                # get distance map if exist in loss, otherwise return array of NaN
-                # if (
-                #     "distance_regression"
-                #     in self.experiment.network_parameters["training_parameters"]["loss_dictionary"].keys()
-                # ):
-                distance_map = estimates["non_lesion_logits"][:, 0].detach().cpu()
-                # else:
-                # distance_map = torch.full((len(prediction), 1), torch.nan)[:, 0]
-            prediction_array.append(prediction.numpy()[self.cohort.cortex_mask])
-            labels_array.append(labels.cpu().numpy()[self.cohort.cortex_mask])
-            features_array.append(data.x.cpu().numpy()[self.cohort.cortex_mask])
-            distance_map_array.append(distance_map.numpy()[self.cohort.cortex_mask])
-            geodesic_array.append(geo_distance.cpu().numpy()[self.cohort.cortex_mask])
-            # only save after right hemi has been run.
-            if hemi == "rh":
-                subject_dictionary = {
-                    "input_labels": np.concatenate(labels_array),
-                    "result": np.concatenate(prediction_array),
-                    "distance_map": np.concatenate(distance_map_array),
-                    "borderzone": np.concatenate(geodesic_array) < 20,
-                }
-                # save prediction
-                if save_prediction:
-                    self.save_prediction(
-                        subj_id,
-                        subject_dictionary["result"],
-                        suffix=save_prediction_suffix,
-                    )
+        # integer indices of cortex vertices on the model device, to only copy cortex vertices to the cpu
+        cortex_idx = torch.as_tensor(self.cohort.cortex_label, dtype=torch.long, device=device)
+
+        def _cortex_both_hemis(values):
+            # values contains lh followed by rh vertices. Returns cortex vertices of lh followed by rh
+            values = values.reshape((2, -1) + tuple(values.shape[1:]))
+            values = values.index_select(1, cortex_idx)
+            return values.reshape((-1,) + tuple(values.shape[2:]))
+
+        if roc_curves_thresholds is not None:
+            # roc counts are accumulated on the model device and added to roc_dictionary after predicting
+            self.thresholds = roc_curves_thresholds
+            roc_thresholds = torch.as_tensor(roc_curves_thresholds, dtype=torch.float32, device=device)
+            roc_counts = {
+                key: torch.zeros(len(roc_thresholds), dtype=torch.long, device=device)
+                for key in ["sensitivity", "sensitivity_plus", "specificity"]
+            }
+
+        distance_regression_flag = "distance_regression" in self.experiment.network_parameters["training_parameters"]["loss_dictionary"]
+        # predictions are written in batches of subjects, so that other processes writing to the
+        # same predictions file only wait for the writes and not for the whole inference
+        saved_predictions = []
+
+        def _flush_predictions():
+            with self.open_prediction_file(save_prediction_suffix) as h5_file:
+                for subj_id, prediction, distance_map in saved_predictions:
+                    self.save_prediction(subj_id, prediction, h5_file=h5_file)
                     # save distance map
-                    self.save_prediction(
-                        subj_id,
-                        subject_dictionary["distance_map"],
-                        dataset_str="distance_map",
-                        suffix=save_prediction_suffix,
+                    self.save_prediction(subj_id, distance_map, dataset_str="distance_map", h5_file=h5_file)
+            saved_predictions.clear()
+
+        # each batch contains both hemispheres of one subject
+        for subject_index, data in enumerate(prefetch_to_device(data_loader, device)):
+            self.log.debug(subject_index)
+            subj_id = self.subject_ids[subject_index]
+            with torch.inference_mode():
+                if self.dropout:
+                    prediction, distance_map = predict_mc_dropout(
+                        model, data.x, self.dropout_p, self.dropout_n, self.dropout_batch_size
                     )
-                # save features if mode is not train
-                if self.mode != "train":
-                    subject_dictionary["input_features"] = np.concatenate(features_array)
-                if store_predictions:
-                    self.data_dictionary[subj_id] = subject_dictionary
-                if roc_curves_thresholds is not None:
-                    self.thresholds = roc_curves_thresholds
-                    self.roc_curves(subject_dictionary)
-
-                if store_sub_aucs and subject_dictionary["input_labels"].sum() > 0:
-                    sub_auc = self.calc_sub_auc(subject_dictionary)
-                    self.subject_aucs[subj_id] = sub_auc
+                else:
+                    estimates = model(data.x)
+                    prediction = torch.exp(estimates["log_softmax"])[:, 1]
+                    # get distance map if exist in loss, otherwise return array of NaN
+                    # if (
+                    #     "distance_regression"
+                    #     in self.experiment.network_parameters["training_parameters"]["loss_dictionary"].keys()
+                    # ):
+                    distance_map = estimates["non_lesion_logits"][:, 0]
+                    # else:
+                    # distance_map = torch.full((len(prediction), 1), torch.nan)[:, 0]
+            labels = _cortex_both_hemis(data.y)
+            prediction = _cortex_both_hemis(prediction)
+            borderzone = _cortex_both_hemis(data.distance_map) < 20
+            if roc_curves_thresholds is not None:
+                # sensitivity and sensitivity_plus for patients (has a label), specificity for controls
+                has_lesion = labels.bool().any()
+                roc_counts["sensitivity"] += has_lesion & (masked_max_torch(prediction, labels.bool()) >= roc_thresholds)
+                roc_counts["sensitivity_plus"] += has_lesion & (masked_max_torch(prediction, borderzone) >= roc_thresholds)
+                roc_counts["specificity"] += ~has_lesion & (prediction.max() < roc_thresholds)
+            subject_dictionary = {
+                "input_labels": labels.cpu().numpy(),
+                "result": prediction.cpu().numpy(),
+                "distance_map": _cortex_both_hemis(distance_map).cpu().numpy(),
+                "borderzone": borderzone.cpu().numpy(),
+            }
+            # save prediction
+            if save_prediction:
+                saved_predictions.append(
+                    (subj_id, subject_dictionary["result"], subject_dictionary["distance_map"])
+                )
+                if len(saved_predictions) >= save_every:
+                    _flush_predictions()
+            # save features if mode is not train
+            if self.mode != "train":
+                subject_dictionary["input_features"] = _cortex_both_hemis(data.x).cpu().numpy()
+            if store_predictions:
+                self.data_dictionary[subj_id] = subject_dictionary
+
+            if store_sub_aucs and subject_dictionary["input_labels"].sum() > 0:
+                sub_auc = self.calc_sub_auc(subject_dictionary)
+                self.subject_aucs[subj_id] = sub_auc
+
+        if saved_predictions:
+            _flush_predictions()
 
         if roc_curves_thresholds is not None:
+            for key, counts in roc_counts.items():
+                self.roc_dictionary[key] += counts.cpu().numpy()
             print('doing it')
             self.calculate_aucs()
             self.save_roc_scores()
@@ -337,12 +399,11 @@ class Evaluator:
 
     def calc_sub_auc(self, subject_dictionary):
         """calculate subject-level aucs"""
-        sub_auc = metrics.roc_auc_score(subject_dictionary["borderzone"], subject_dictionary["result"])
+        sub_auc = roc_auc(subject_dictionary["borderzone"], subject_dictionary["result"])
         return sub_auc
 
     def save_sub_aucs(self, suffix=""):
         """save out the dictionary"""
-        import pickle
         suffix = f"{suffix}{self.dropout_suffix}"
         filename = os.path.join(self.results_dir, f"sub_aucs{suffix}.pickle")
         with open(filename, "wb") as write_file:
@@ -360,7 +421,6 @@ class Evaluator:
         return
 
     def save_roc_scores(self, suffix=""):
-        import pickle
         suffix = f"{suffix}{self.dropout_suffix}"
         filename = os.path.join(self.results_dir, f"roc_auc{suffix}.pickle")
         with open(filename, "wb") as write_file:
@@ -369,25 +429,7 @@ class Evaluator:
 
     def roc_curves(self, subject_dictionary):
         """calculate performance at multiple thresholds"""
-        for t_i, threshold in enumerate(self.thresholds):
-            predicted = subject_dictionary["result"] >= threshold
-            # if we want tpr vs fpr curve too
-            # tp,fp,fn, tn = tp_fp_fn_tn(predicted, subject_dictionary['input_labels'])
-            # store sensitivity and sensitivity_plus for each patient (has a label)
-            if subject_dictionary["input_labels"].sum() > 0:
-                self.roc_dictionary["sensitivity"][t_i] += np.logical_and(
-                    predicted, subject_dictionary["input_labels"]
-                ).any()
-                self.roc_dictionary["sensitivity_plus"][t_i] += np.logical_and(
-                    predicted, subject_dictionary["borderzone"]
-                ).any()
-                # could break if no longer detecting
-            # store specificity for controls (no label)
-            else:
-                self.roc_dictionary["specificity"][t_i] += ~predicted.any()
-                # could break if no longer predicting
-
-                # initialise dictionary
+        roc_curves(subject_dictionary, self.roc_dictionary, self.thresholds)
 
     @property
     def roc_dictionary(self):
@@ -409,18 +451,21 @@ class Evaluator:
                 islands = self.cluster_and_area_threshold(mask, island_count=island_count, min_area_threshold=self.min_area_threshold)
                 result_hemis_clustered[hemi] = islands
                 island_count += np.max(islands)
-            return np.hstack([result_hemis_clustered['left'][self.cohort.cortex_mask],result_hemis_clustered['right'][self.cohort.cortex_mask]])
+            return self.cohort.combine_hemispheres(result_hemis_clustered['left'], result_hemis_clustered['right'])
 
         save_prediction_suffix = f"{save_prediction_suffix}{self.dropout_suffix}"
         return_dict = data_dictionary is not None
         if data_dictionary is None:
             data_dictionary = self.data_dictionary
+        if self.threshold_mode == 'sigmoid':
+            # subject-level thresholds of all subjects at once
+            ymin, ymax, k, m = self.threshold
+            print('Using sigmoid params: {}, {}, {}, {}'.format(ymin, ymax, k, m))
+            min_distances = np.array([data["distance_map"].min() for data in data_dictionary.values()])
+            sigmoid_thresholds = dict(zip(data_dictionary.keys(), sigmoid(min_distances, k=k, m=m, ymin=ymin, ymax=ymax)))
         for subj_id, data in data_dictionary.items():
             if self.threshold_mode == 'sigmoid':
-                distances = data["distance_map"]
-                ymin, ymax, k, m = self.threshold
-                print('Using sigmoid params: {}, {}, {}, {}'.format(ymin, ymax, k, m))
-                threshold_subj = sigmoid(np.array([distances.min()]), k=k, m=m, ymin=ymin, ymax=ymax)[0]
+                threshold_subj = sigmoid_thresholds[subj_id]
                 print(f"threshold_subj = {threshold_subj}")
             else:
                 threshold_subj = self.threshold
@@ -431,14 +476,19 @@ class Evaluator:
                 # initialise best threshold to be the smallest one
                 thresholds = np.sort(threshold_subj)[::-1] 
                 best_threshold = thresholds[-1]
+                best_cluster_thresholded = None
                 # loop over descending thresholds and keep the highest threshold that give a prediction 
                 for threshold in thresholds:
                     if data["result"].max() > threshold:
                         cluster_thresholded = get_cluster_thresholded(predictions, threshold)
                         if cluster_thresholded.sum() > 0 :
                             best_threshold = threshold
+                            best_cluster_thresholded = cluster_thresholded
                             break
-                cluster_thresholded = get_cluster_thresholded(predictions, best_threshold)
+                # only cluster again if no threshold gave a prediction
+                if best_cluster_thresholded is None:
+                    best_cluster_thresholded = get_cluster_thresholded(predictions, best_threshold)
+                cluster_thresholded = best_cluster_thresholded
                 print(f"threshold_subj = {best_threshold}")
                 data["threshold"] = best_threshold
                 data["cluster_thresholded"] = cluster_thresholded
@@ -457,9 +507,10 @@ class Evaluator:
                     cluster_thresholded = get_cluster_thresholded(predictions, threshold)
                     if cluster_thresholded.sum() > 0 :
                         best_threshold = threshold
+                # only cluster again if no threshold gave a prediction
                 if best_threshold==0:
                     best_threshold = 0.01
-                cluster_thresholded = get_cluster_thresholded(predictions, best_threshold)
+                    cluster_thresholded = get_cluster_thresholded(predictions, best_threshold)
                 print(f"threshold_subj = {best_threshold}")
                 data["threshold"] = best_threshold
                 data["cluster_thresholded"] = cluster_thresholded
@@ -489,14 +540,15 @@ class Evaluator:
                     data["threshold"] = threshold_subj[0]   
             else:
                 data["cluster_thresholded"] = get_cluster_thresholded(predictions, threshold_subj)
-            if save_prediction:
-                # save clustered predictions
-                self.save_prediction(
-                            subj_id,
-                            data["cluster_thresholded"],
-                            dataset_str="prediction_clustered",
-                            suffix=save_prediction_suffix,
-                        )
+        if save_prediction:
+            # save clustered predictions of all subjects
+            self.save_predictions_bulk(
+                        ((subj_id, data["cluster_thresholded"]) for subj_id, data in data_dictionary.items()),
+                        dataset_str="prediction_clustered",
+                        suffix=save_prediction_suffix,
+                        dtype=np.float32,
+                        compression="lzf",
+                    )
         if return_dict:
             return data_dictionary
         else:
@@ -539,34 +591,57 @@ class Evaluator:
                     data[mask_salient_key] = self.experiment.cohort.split_hemispheres(data[mask_salient_key])
 
         if ('input_features' in keys) or ('input_labels' in keys):
-            # load features from using dataset
-            dataset = GraphDataset([subj_id], self.cohort, self.experiment.data_parameters, mode="test")
-            data_loader = torch_geometric.loader.DataLoader(dataset,shuffle=False,batch_size=1,)
-            features_hemis = []
-            labels_hemis = []
-            for i, sample in enumerate(data_loader):
-                features_hemis.append(sample.x)
-                labels_hemis.append(sample.y)
+            features_hemis, labels_hemis = self._load_subject_features(subj_id)
             if 'input_features' in keys:
                 if split_hemis:
                     data['input_features'] = {}
-                    data['input_features']['left'] = np.array(features_hemis[0])
-                    data['input_features']['right'] = np.array(features_hemis[1])
+                    data['input_features']['left'] = features_hemis[0]
+                    data['input_features']['right'] = features_hemis[1]
                 else:
-                    data['input_features'] = np.hstack([features_hemis[0][self.experiment.cohort.cortex_mask].T,features_hemis[1][self.experiment.cohort.cortex_mask].T]).T
+                    data['input_features'] = self.experiment.cohort.combine_hemispheres(features_hemis[0], features_hemis[1])
             if 'input_labels' in keys:
                 if split_hemis:
                     data['input_labels'] = {}
-                    data['input_labels']['left'] =  np.array(labels_hemis[0])
-                    data['input_labels']['right'] = np.array(labels_hemis[1])
+                    data['input_labels']['left'] = labels_hemis[0]
+                    data['input_labels']['right'] = labels_hemis[1]
                 else:
-                    data['input_labels'] = np.hstack([labels_hemis[0][self.experiment.cohort.cortex_mask],labels_hemis[1][self.experiment.cohort.cortex_mask]])
+                    data['input_labels'] = self.experiment.cohort.combine_hemispheres(labels_hemis[0], labels_hemis[1])
         
         return data
-    
+
+    def _load_subject_features(self, subj_id):
+        """
+        load features and labels of both hemispheres of a subject using GraphDataset.
+        Returns arrays of shape (2, n_vertices, n_features) and (2, n_vertices).
+        Uses self.dataset if it contains the subject without augmentation, otherwise loads the subject.
+        The most recent subject is cached, as its data is usually requested several times in a row.
+        """
+        if subj_id not in self._subject_features_cache:
+            subject_ids = [] if self.dataset is None else list(self.dataset.subject_ids)
+            if (
+                subj_id in subject_ids
+                and self.dataset.tensor_list is not None
+                and not self.dataset.params["synthetic_data"]["run_synthetic"]
+            ):
+                # data of each subject is stored in order: left, right
+                s_i = subject_ids.index(subj_id)
+                samples = [self.dataset[2 * s_i], self.dataset[2 * s_i + 1]]
+                features_hemis = np.stack([sample.x.numpy() for sample in samples])
+                labels_hemis = np.stack([sample.y.numpy() for sample in samples])
+            else:
+                dataset = GraphDataset([subj_id], self.cohort, self.experiment.data_parameters, mode="test")
+                # load both hemispheres as one batch, lh followed by rh
+                data_loader = torch_geometric.loader.DataLoader(dataset,shuffle=False,batch_size=2,)
+                sample = next(iter(data_loader))
+                features_hemis = sample.x.numpy().reshape((2, -1, sample.x.shape[1]))
+                labels_hemis = sample.y.numpy().reshape((2, -1))
+            self._subject_features_cache = {subj_id: (features_hemis, labels_hemis)}
+        return self._subject_features_cache[subj_id]
+
     def calculate_saliency(
         self,
         save_prediction_suffix="",
+        max_clusters_per_batch=4,
     ):
         """
         Calculate saliency for all subjects.
@@ -578,6 +653,10 @@ class Evaluator:
         The saliency is calculate for all vertices in the cluster with respect to all vertices in the cluster. 
         The mean saliency is saved in a csv file with name saliency{suffix}.csv, with subj_id, cluster_id, and aggregation function (mean,std) as indices and saliency for n_features as values.
         This csv can be read using `pd.read_csv('saliency.csv', index_col=[0,1,2])`.
+
+        Args:
+            max_clusters_per_batch (int): number of clusters of a hemisphere whose saliency is calculated in one batch.
+                Each cluster adds a copy of the hemisphere to the model inputs.
         """
         save_prediction_suffix = f"{save_prediction_suffix}{self.dropout_suffix}"
         # helper functions
@@ -605,16 +684,14 @@ class Evaluator:
             data['cluster_thresholded'] = self.experiment.cohort.split_hemispheres(data['cluster_thresholded'])
             
             # load features from using dataset
-            dataset = GraphDataset([subj_id], self.cohort, self.experiment.data_parameters, mode="test")
-            data_loader = torch_geometric.loader.DataLoader(dataset,shuffle=False,batch_size=1,)
-            hemis = ['left', 'right']
+            features_hemis, _ = self._load_subject_features(subj_id)
             data['input_features'] = {}
-            for i, sample in enumerate(data_loader):
-                data['input_features'][hemis[i]] = sample.x
+            for i, hemi in enumerate(['left', 'right']):
+                data['input_features'][hemi] = torch.as_tensor(features_hemis[i])
             return data
         
         self.log.info('calculating saliency')
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        device = self.device
         # prepare saliency model
         saliency_model = IntegratedGradients(PredictionForSaliency(self.experiment.model))
         saliency_vert = {}
@@ -634,18 +711,19 @@ class Evaluator:
                         raise ValueError("Could not successfully calculate predictions and thresholds for saliency calculation.")
             saliency_vert[subj_id] = {}
             mask_salient_vert[subj_id] = {}
-            pred_clust_salient = np.hstack([data_dict['cluster_thresholded']['left'][self.experiment.cohort.cortex_mask].T, data_dict['cluster_thresholded']['right'][self.experiment.cohort.cortex_mask].T]).T       
+            pred_clust_salient = self.experiment.cohort.combine_hemispheres(data_dict['cluster_thresholded']['left'], data_dict['cluster_thresholded']['right'])
             for hemi in ['left', 'right']:
-                # calculate saliency for every cluster
-                for cl in np.unique(data_dict['cluster_thresholded'][hemi]):
-                    if cl == 0:  # dont do background cluster
-                        continue
-                    self.log.info(f'calculating saliency for {subj_id}, cluster {cl}')
-                    mask = data_dict['cluster_thresholded'][hemi] == cl
-                    
-                    inputs = data_dict['input_features'][hemi].to(device)
-                    cur_saliency = saliency_model.attribute(inputs, additional_forward_args=mask, target=1, n_steps=25, 
-                                                method='gausslegendre', internal_batch_size=100).cpu().numpy()
+                # dont do background cluster
+                clusters = np.unique(data_dict['cluster_thresholded'][hemi])
+                clusters = clusters[clusters != 0]
+                if len(clusters) == 0:
+                    continue
+                self.log.info(f'calculating saliency for {subj_id}, clusters {clusters}')
+                # calculate saliency for batches of clusters, with one copy of the inputs per cluster
+                masks = data_dict['cluster_thresholded'][hemi][None, :] == clusters[:, None]
+                inputs = data_dict['input_features'][hemi].to(device)
+                saliencies = cluster_saliencies(saliency_model, inputs, masks, max_clusters_per_batch)
+                for cl, mask, cur_saliency in zip(clusters, masks, saliencies):
                     # extract mask of most salient vertices
                     mean_saliencies = cur_saliency.mean(axis=1)
                     # extract 20% most salient vertices
@@ -663,11 +741,11 @@ class Evaluator:
                     empty_hemi = np.zeros(cur_saliency.shape)
                     
                     if hemi=='left':
-                        saliency_vert[subj_id][cl] = np.hstack([cur_saliency[self.experiment.cohort.cortex_mask,:].T,empty_hemi[self.experiment.cohort.cortex_mask,:].T]).T
-                        mask_salient_vert[subj_id][cl] = np.hstack([mask_salient[self.experiment.cohort.cortex_mask],empty_hemi[self.experiment.cohort.cortex_mask, 0]])
+                        saliency_vert[subj_id][cl] = self.experiment.cohort.combine_hemispheres(cur_saliency, empty_hemi)
+                        mask_salient_vert[subj_id][cl] = self.experiment.cohort.combine_hemispheres(mask_salient, empty_hemi[:, 0])
                     else:
-                        saliency_vert[subj_id][cl] = np.hstack([empty_hemi[self.experiment.cohort.cortex_mask,:].T, cur_saliency[self.experiment.cohort.cortex_mask,:].T]).T
-                        mask_salient_vert[subj_id][cl] = np.hstack([empty_hemi[self.experiment.cohort.cortex_mask, 0], mask_salient[self.experiment.cohort.cortex_mask]])
+                        saliency_vert[subj_id][cl] = self.experiment.cohort.combine_hemispheres(empty_hemi, cur_saliency)
+                        mask_salient_vert[subj_id][cl] = self.experiment.cohort.combine_hemispheres(empty_hemi[:, 0], mask_salient)
                     # save saliency
                     self.save_prediction(
                         subj_id,
@@ -683,6 +761,8 @@ class Evaluator:
                         mask_salient_vert[subj_id][cl],
                         dataset_str=f"mask_salient_{cl}",
                         suffix=save_prediction_suffix,
+                        dtype=np.float32,
+                        compression="lzf",
                     ) 
                     
                     # add salient vertices for each cluster to prediction clustered
@@ -694,29 +774,37 @@ class Evaluator:
                 pred_clust_salient,
                 dataset_str=f"cluster_thresholded_salient",
                 suffix=save_prediction_suffix,
+                dtype=np.float32,
+                compression="lzf",
                 )
 
     
     def stat_subjects(self, suffix="", fold=None):
         """calculate stats for each subjects"""
         suffix = f"{suffix}{self.dropout_suffix}"
+        filename = os.path.join(self.results_dir, f"test_results.csv")
+        if fold is not None:
+            filename = os.path.join(self.results_dir, f"test_results_{fold}.csv")
+        # collect results of all subjects and write them at once
+        sub_rows = []
         # calculate stats on thresholded and clustered predictions
-        for subject in self.data_dictionary.keys():
+        for subject, data in self.data_dictionary.items():
             # use prediction clustered
-            if not isinstance(self.data_dictionary[subject]["cluster_thresholded"], np.ndarray):
+            if not isinstance(data["cluster_thresholded"], np.ndarray):
                 print('Cannot perform stats on non-thresholded and clustered data')
-                return
-            prediction = self.data_dictionary[subject]["cluster_thresholded"]
-            labels = self.data_dictionary[subject]["input_labels"]
-            boundary_zone = self.data_dictionary[subject]["borderzone"]
-            
-            group = labels.sum() != 0
+                break
+            prediction = data["cluster_thresholded"]
+            labels = data["input_labels"].astype(bool)
+            boundary_zone = data["borderzone"]
+            predicted = prediction > 0
+
+            group = labels.any()
 
-            detected = np.logical_and(prediction>0, boundary_zone).any()
-            difference = np.setdiff1d(np.unique(prediction), np.unique(prediction[boundary_zone]))
+            detected = np.logical_and(predicted, boundary_zone).any()
+            correct_values = np.unique(prediction[boundary_zone])
+            difference = np.setdiff1d(np.unique(prediction), correct_values)
             difference = difference[difference > 0]
             n_clusters = len(difference)
-            correct_values = np.unique(prediction[boundary_zone])
             correct_values = correct_values[correct_values > 0]
             n_tp_clusters = len(correct_values)
             # # if not detected, does a cluster overlap boundary zone and if so, how big is the cluster?
@@ -730,166 +818,147 @@ class Evaluator:
             # else:
             #     border_detected = 0
             patient_dice_vars = {"TP": 0, "FP": 0, "FN": 0, "TN": 0}
-            mask = torch.as_tensor(np.array(prediction > 0)).long()
-            label = torch.as_tensor(np.array(labels.astype(bool))).long()
-            dices = dice_coeff(torch.nn.functional.one_hot(mask, num_classes=2), label)
             (
                 patient_dice_vars["TP"],
                 patient_dice_vars["FP"],
                 patient_dice_vars["FN"],
                 patient_dice_vars["TN"],
-            ) = tp_fp_fn_tn(mask, label)
+            ) = confusion_counts(predicted, labels)
             (
-                patient_dice_vars["Dice non-lesion"],
                 patient_dice_vars["Dice lesion"],
-            ) = list(dices)
-
-            sub_df = pd.DataFrame(
-                np.array(
-                    [
-                        subject,
-                        group,
-                        detected,
-                        n_clusters,
-                        n_tp_clusters,
-                        patient_dice_vars["TP"].numpy(),
-                        patient_dice_vars["FP"].numpy(),
-                        patient_dice_vars["FN"].numpy(),
-                        patient_dice_vars["TN"].numpy(),
-                        patient_dice_vars["Dice lesion"].numpy(),
-                        patient_dice_vars["Dice non-lesion"].numpy(),
-                    ]
-                )
-                .reshape(-1, 1)
-                .T,
-                columns=[
-                    "ID",
-                    "group",
-                    "detected",
-                    "number FP clusters",
-                    "number TP clusters",
-                    "tp",
-                    "fp",
-                    "fn",
-                    "tn",
-                    "dice lesional",
-                    "dice non-lesional",
-                ],
+                patient_dice_vars["Dice non-lesion"],
+            ) = dice_from_confusion(
+                patient_dice_vars["TP"],
+                patient_dice_vars["FP"],
+                patient_dice_vars["FN"],
+                patient_dice_vars["TN"],
             )
-            # save results
-            filename = os.path.join(self.results_dir, f"test_results.csv")
-            if fold is not None:
-                filename = os.path.join(self.results_dir, f"test_results_{fold}.csv")
-
-            if os.path.isfile(filename):
-                done = False
-                while not done:
-                    try:
-                        df = pd.read_csv(filename, index_col=False)
-                        # df = df.append(sub_df, ignore_index=True)
-                        df = pd.concat([df, sub_df], ignore_index=True, sort=False)
-                        df.to_csv(filename, index=False)
-                        done = True
-                    except pd.errors.EmptyDataError:
-                        done = False
-            else:
-                sub_df.to_csv(filename, index=False)
 
-    def plot_subjects_prediction(self, rootfile=None, flat_map=True, suffix=""):
-        """plot predicted subjects"""
-        import matplotlib.pyplot as plt
-        from matplotlib.gridspec import GridSpec
+            sub_rows.append(
+                {
+                    "ID": subject,
+                    "group": group,
+                    "detected": detected,
+                    "number FP clusters": n_clusters,
+                    "number TP clusters": n_tp_clusters,
+                    "tp": patient_dice_vars["TP"],
+                    "fp": patient_dice_vars["FP"],
+                    "fn": patient_dice_vars["FN"],
+                    "tn": patient_dice_vars["TN"],
+                    "dice lesional": patient_dice_vars["Dice lesion"],
+                    "dice non-lesional": patient_dice_vars["Dice non-lesion"],
+                }
+            )
+        # save results, only write the header when creating the file
+        if len(sub_rows) > 0:
+            pd.DataFrame(sub_rows).to_csv(filename, mode="a", header=not os.path.isfile(filename), index=False)
 
-        plt.close("all")
+    def plot_subjects_prediction(self, rootfile=None, flat_map=True, suffix="", max_workers=1):
+        """plot predicted subjects
 
+        Args:
+            max_workers (int): maximum number of processes rendering the (up to 6) surfaces of a subject in parallel.
+                Defaults to 1, rendering in this process. Workers are only used for several subjects, as each
+                spawned worker imports meld_graph. Scripts using workers need an `if __name__ == "__main__"` block.
+        """
         # create directory to save images
         if not os.path.isdir(os.path.join(self.results_dir, "images")):
             os.makedirs(os.path.join(self.results_dir, "images"), exist_ok=True)
 
-        for subject in self.data_dictionary.keys():
-            if rootfile is not None:
-                filename = os.path.join(rootfile.format(subject))
-            else:
-                filename = os.path.join(self.results_dir, "images", "{}{}.jpg".format(subject,suffix))
-                os.makedirs(
-                    os.path.join(
-                        self.results_dir,
-                        "images",
-                    ),
-                    exist_ok=True,
-                )
+        max_workers = min(max_workers, os.cpu_count() or 1)
+        if max_workers > 1 and len(self.data_dictionary) > 1:
+            # spawn workers rather than forking this process, which may have initialised cuda.
+            # Each worker loads the surface mesh once, so only the overlays are sent with each task
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_surface_plot_worker,
+                initargs=(flat_map,),
+            )
+            plot_surfaces = functools.partial(executor.map, _create_surface_plot_in_worker)
+        else:
+            executor = contextlib.nullcontext()
+            coords, faces = get_surface_mesh(flat_map)
 
-            distance_map = self.data_dictionary[subject]["distance_map"]
-            # if clustered predictions exists takes that, otherwise take raw predictions
-            if isinstance(self.data_dictionary[subject]["cluster_thresholded"], np.ndarray):
-                result = self.data_dictionary[subject]["cluster_thresholded"]
-            else:
-                result = self.data_dictionary[subject]["result"]
-            result = np.reshape(result, len(result))
-            label = self.data_dictionary[subject]["input_labels"]
+            def plot_surfaces(overlays):
+                return [create_surface_plots(coords, faces, overlay, flat_map=flat_map) for overlay in overlays]
+
+        with executor:
+            for subject in self.data_dictionary.keys():
+                if rootfile is not None:
+                    filename = os.path.join(rootfile.format(subject))
+                else:
+                    filename = os.path.join(self.results_dir, "images", "{}{}.jpg".format(subject,suffix))
+                    os.makedirs(
+                        os.path.join(
+                            self.results_dir,
+                            "images",
+                        ),
+                        exist_ok=True,
+                    )
+
+                distance_map = self.data_dictionary[subject]["distance_map"]
+                # if clustered predictions exists takes that, otherwise take raw predictions
+                if isinstance(self.data_dictionary[subject]["cluster_thresholded"], np.ndarray):
+                    result = self.data_dictionary[subject]["cluster_thresholded"]
+                else:
+                    result = self.data_dictionary[subject]["result"]
+                result = np.reshape(result, len(result))
+                label = self.data_dictionary[subject]["input_labels"]
            
-            result_hemis = self.experiment.cohort.split_hemispheres(result)
-            distance_map_hemis = self.experiment.cohort.split_hemispheres(distance_map)
-            label_hemis = self.experiment.cohort.split_hemispheres(label)
-
-            # initialise the icosphere or flat map
-            if flat_map != True:
-                from meld_graph.icospheres import IcoSpheres
-
-                icos = IcoSpheres()
-                ico_ini = icos.icospheres[7]
-                coords = ico_ini["coords"]
-                faces = ico_ini["faces"]
-            else:
-                import nibabel as nb
-                from meld_graph.paths import MELD_PARAMS_PATH
-
-                flat = nb.load(os.path.join(MELD_PARAMS_PATH, "fsaverage_sym", "surf", "lh.full.patch.flat.gii"))
-                coords, faces = flat.darrays[0].data, flat.darrays[1].data
-
-            # round up to get the square grid size
-            fig = plt.figure(figsize=(11, 8), constrained_layout=True)
-            gs1 = GridSpec(3, 2, width_ratios=[1, 1], wspace=0.1, hspace=0.1)
-            if not np.isnan(distance_map_hemis["left"]).any():
-                data_to_plot = [
-                    result_hemis["left"],
-                    result_hemis["right"],
-                    distance_map_hemis["left"],
-                    distance_map_hemis["right"],
-                    label_hemis["left"],
-                    label_hemis["right"],
-                ]
-                titles = [
-                    "predictions left hemi",
-                    "predictions right hemi",
-                    "distance map left hemi",
-                    "distance map right hemi",
-                    "labels left hemi",
-                    "labels right hemi",
-                ]
-            else:
-                data_to_plot = [
-                    result_hemis["left"],
-                    result_hemis["right"],
-                    label_hemis["left"],
-                    label_hemis["right"],
-                ]
-                titles = [
-                    "predictions left hemi",
-                    "predictions right hemi",
-                    "labels left hemi",
-                    "labels right hemi",
-                ]
-            for i, overlay in enumerate(data_to_plot):
-                ax = fig.add_subplot(gs1[i])
-                im = create_surface_plots(coords, faces, overlay, flat_map=True)
-                ax.imshow(im)
-                ax.axis("off")
-                ax.set_title(titles[i], loc="left", fontsize=20)
-            fig.savefig(filename, bbox_inches="tight")
-            plt.close("all")
-
-    def save_prediction(self, subject, prediction, dataset_str="prediction", dtype=None, suffix=""):
+                result_hemis = self.experiment.cohort.split_hemispheres(result)
+                distance_map_hemis = self.experiment.cohort.split_hemispheres(distance_map)
+                label_hemis = self.experiment.cohort.split_hemispheres(label)
+
+                # round up to get the square grid size
+                fig = plt.figure(figsize=(11, 8), constrained_layout=True)
+                gs1 = GridSpec(3, 2, width_ratios=[1, 1], wspace=0.1, hspace=0.1)
+                if not np.isnan(distance_map_hemis["left"]).any():
+                    data_to_plot = [
+                        result_hemis["left"],
+                        result_hemis["right"],
+                        distance_map_hemis["left"],
+                        distance_map_hemis["right"],
+                        label_hemis["left"],
+                        label_hemis["right"],
+                    ]
+                    titles = [
+                        "predictions left hemi",
+                        "predictions right hemi",
+                        "distance map left hemi",
+                        "distance map right hemi",
+                        "labels left hemi",
+                        "labels right hemi",
+                    ]
+                else:
+                    data_to_plot = [
+                        result_hemis["left"],
+                        result_hemis["right"],
+                        label_hemis["left"],
+                        label_hemis["right"],
+                    ]
+                    titles = [
+                        "predictions left hemi",
+                        "predictions right hemi",
+                        "labels left hemi",
+                        "labels right hemi",
+                    ]
+                ims = plot_surfaces(data_to_plot)
+                for i, im in enumerate(ims):
+                    ax = fig.add_subplot(gs1[i])
+                    ax.imshow(im)
+                    ax.axis("off")
+                    ax.set_title(titles[i], loc="left", fontsize=20)
+                fig.savefig(filename, bbox_inches="tight")
+                plt.close(fig)
+
+    def prediction_filename(self, suffix=""):
+        """path of the hdf5 file predictions are saved to"""
+        return os.path.join(self.results_dir, f"predictions{suffix}.hdf5")
+
+    def save_prediction(
+        self, subject, prediction, dataset_str="prediction", dtype=None, suffix="", h5_file=None, compression=None
+    ):
         """
         saves prediction to {experiment_path}/results/predictions.hdf5.
         the hdf5 has the structure (subject_id/hemisphere/prediction).
@@ -897,6 +966,8 @@ class Evaluator:
         dataset_str: name of the dataset to save prediction. If is 'prediction', also saves threshold
         dtype: dtype of the dataset. If none, use dtype of prediction.
         suffix: suffix for the filename for the prediction: "predictions{suffix}.hdf5" is used
+        h5_file: already opened predictions file to write to. If None, opens the file for this prediction.
+        compression: hdf5 compression filter for new datasets, e.g. "lzf" for mostly constant cluster labels.
         """
         # make sure that give prediction has expected length
         nvert_hemi = len(self.experiment.cohort.cortex_label)
@@ -905,66 +976,126 @@ class Evaluator:
         if dtype is None:
             dtype = prediction.dtype
 
-        filename = os.path.join(self.results_dir, f"predictions{suffix}.hdf5")
-        if not os.path.isfile(filename):
-            mode = "a"
-        else:
-            mode = "r+"
-        done = False
-        while not done:
-            try:
-                with h5py.File(filename, mode=mode) as f:
-                    self.log.info(f"saving {dataset_str} for {subject}")
-                    for i, hemi in enumerate(["lh", "rh"]):
-                        shape = tuple([nvert_hemi] + list(prediction.shape[1:]))
-                        # create dataset
-                        dset = f.require_dataset(f"{subject}/{hemi}/{dataset_str}", shape=shape, dtype=dtype)
-                        # save prediction in dataset
-                        dset[:] = prediction[i * nvert_hemi : (i + 1) * nvert_hemi]
-                        # if dataset_str == "prediction":
-                        # save threshold as attribute in dataset
-                        # dset.attrs["threshold"] = self.threshold
-                    done = True
-            except OSError:
-                done = False
+        if h5_file is not None:
+            self._write_prediction(h5_file, subject, prediction, dataset_str, dtype, nvert_hemi, compression)
+            return
+
+        with self.open_prediction_file(suffix) as f:
+            self._write_prediction(f, subject, prediction, dataset_str, dtype, nvert_hemi, compression)
+
+    @contextlib.contextmanager
+    def open_prediction_file(self, suffix=""):
+        """
+        open predictions file for writing.
+        Other processes writing to the same file wait until it is closed again.
+        Processes that opened the file without this lock (e.g. readers) are waited for up to
+        PREDICTION_FILE_OPEN_ATTEMPTS seconds.
+        """
+        filename = self.prediction_filename(suffix)
+        with file_lock(filename):
+            for attempt in range(PREDICTION_FILE_OPEN_ATTEMPTS):
+                try:
+                    f = h5py.File(
+                        filename,
+                        mode="a",
+                        libver="latest",
+                        rdcc_nbytes=PREDICTION_CHUNK_CACHE_NBYTES,
+                        rdcc_nslots=PREDICTION_CHUNK_CACHE_NSLOTS,
+                    )
+                    break
+                except OSError:
+                    if attempt == PREDICTION_FILE_OPEN_ATTEMPTS - 1:
+                        raise
+                    self.log.debug(f"could not open {filename}, retrying")
+                    time.sleep(1)
+            with f:
+                yield f
+
+    def _write_prediction(self, f, subject, prediction, dataset_str, dtype, nvert_hemi, compression=None):
+        """write prediction of both hemispheres to open hdf5 file f"""
+        self.log.info("saving %s for %s", dataset_str, subject)
+        shape = (nvert_hemi,) + prediction.shape[1:]
+        hemi_slices = {"lh": slice(0, nvert_hemi), "rh": slice(nvert_hemi, 2 * nvert_hemi)}
+        for hemi, hemi_slice in hemi_slices.items():
+            # create dataset, stored as one chunk per hemisphere as hemispheres are always read and written whole
+            dset = f.require_dataset(
+                f"{subject}/{hemi}/{dataset_str}", shape=shape, dtype=dtype, chunks=shape, compression=compression
+            )
+            # save prediction in dataset
+            dset[:] = prediction[hemi_slice]
+            # if dataset_str == "prediction":
+            # save threshold as attribute in dataset
+            # dset.attrs["threshold"] = self.threshold
+
+    def save_predictions_bulk(self, items, dataset_str="prediction", dtype=None, suffix="", compression=None):
+        """
+        save predictions of several subjects, opening the predictions file once.
+        items: iterable of (subject, prediction). Other arguments as in save_prediction.
+        """
+        with self.open_prediction_file(suffix) as f:
+            for subject, prediction in items:
+                self.save_prediction(
+                    subject, prediction, dataset_str=dataset_str, dtype=dtype, h5_file=f, compression=compression
+                )
 
     def load_prediction(self, subject, dataset_str="prediction", suffix=""):
         """
         load prediction from file.
         """
-        filename = os.path.join(self.results_dir, f"predictions{suffix}.hdf5")
+        return self.load_predictions_bulk([subject], dataset_str=dataset_str, suffix=suffix).get(subject)
+
+    def load_predictions_bulk(self, subjects, dataset_str="prediction", suffix=""):
+        """
+        load predictions of several subjects from file, opening the predictions file once.
+        Returns dictionary with predictions per subject. Predictions that do not exist are None.
+        """
+        filename = self.prediction_filename(suffix)
         if not os.path.isfile(filename):
             # cannot load data
             self.log.debug(f'file {filename} does not exist')
+            return {}
+        with h5py.File(
+            filename, mode="r", rdcc_nbytes=PREDICTION_CHUNK_CACHE_NBYTES, rdcc_nslots=PREDICTION_CHUNK_CACHE_NSLOTS
+        ) as f:
+            return {subject: self._read_prediction(f, subject, dataset_str) for subject in subjects}
+
+    def _read_prediction(self, f, subject, dataset_str):
+        """read prediction of both hemispheres from open hdf5 file f"""
+        try:
+            dsets = [f[f"{subject}/{hemi}/{dataset_str}"] for hemi in ["lh", "rh"]]
+        except KeyError:
+            # dataset does not exist, cannot load data
+            self.log.debug(f'dataset does not exist {subject}/{dataset_str}')
             return None
-        with h5py.File(filename, mode='r') as f:
-            prediction = []
-            try:
-                for i, hemi in enumerate(["lh", "rh"]):
-                    prediction.append(f[f"{subject}/{hemi}/{dataset_str}"][:])
-                prediction = np.concatenate(prediction)
-            except KeyError:
-                # dataset does not exist, cannot load data
-                self.log.debug(f'dataset does not exist {subject}/{hemi}/{dataset_str}')
-                prediction = None
+        # read both hemispheres straight into one preallocated array
+        nvert_hemi = len(dsets[0])
+        prediction = np.empty((2 * nvert_hemi,) + dsets[0].shape[1:], dtype=dsets[0].dtype)
+        for i, dset in enumerate(dsets):
+            dset.read_direct(prediction, dest_sel=np.s_[i * nvert_hemi : (i + 1) * nvert_hemi])
         return prediction
-   
+
     def cluster_and_area_threshold(self, mask, island_count=0, min_area_threshold=0):
         """cluster predictions and threshold based on min_area_threshold
 
         Args:
             mask: boolean mask of the per-vertex lesion predictions to cluster"""
-        n_comp, labels = scipy.sparse.csgraph.connected_components(self.experiment.cohort.adj_mat[mask][:, mask])
+        # build the graph of the masked vertices from the edges between them
+        rows, cols = self.experiment.cohort.adj_edges
+        edges = mask[rows] & mask[cols]
+        # consecutive index of each masked vertex
+        index = np.cumsum(mask) - 1
+        n_masked = index[-1] + 1
+        graph = scipy.sparse.csr_matrix(
+            (np.ones(edges.sum(), np.uint8), (index[rows[edges]], index[cols[edges]])),
+            shape=(n_masked, n_masked),
+        )
+        # mesh edges are only stored in one direction per face, so treat the graph as undirected
+        n_comp, labels = scipy.sparse.csgraph.connected_components(graph, directed=False, return_labels=True)
         islands = np.zeros(len(mask))
-        # only include islands larger than minimum size.
-        for island_index in np.arange(n_comp):
-            include_vec = labels == island_index
-            size = np.sum(include_vec)
-            if size >= min_area_threshold:
-                island_count += 1
-                island_mask = mask.copy()
-                island_mask[mask] = include_vec
-                islands[island_mask] = island_count
+        # only include islands larger than minimum size, numbered consecutively after island_count
+        keep = np.bincount(labels, minlength=n_comp) >= min_area_threshold
+        island_ids = np.where(keep, np.cumsum(keep) + island_count, 0)
+        islands[mask] = island_ids[labels]
         return islands
 
     def save_confidence_csv(self, suffix="" ):
@@ -1061,9 +1192,9 @@ class Evaluator:
             data_dictionary = self.data_dictionary
 
         maxes =[]
-        for subject in self.data_dictionary.keys():
+        for subject, data in self.data_dictionary.items():
             if "_C_" in subject:
-                maxes.append(np.max(self.data_dictionary[subject]["result"]))
+                maxes.append(np.max(data["result"]))
         maxes = np.array(maxes)
         #shortcut here
         ymin = np.percentile(maxes,60)
@@ -1084,25 +1215,111 @@ def get_scores(subjects_dict, thresholds):
         """
         return sensitivity & dice for given threshold
         """
-        patient_sens = []
-        control_spec = []
-        dice = []
-        for subj, thresh in zip(subjects_dict, thresholds):
-            subj = subjects_dict[subj]
-            mask = torch.as_tensor(np.array(subj['result'] >= thresh)).long()
-            label = torch.as_tensor(np.array(subj['input_labels'].astype(bool))).long()
-            dices = dice_coeff(torch.nn.functional.one_hot(mask, num_classes=2), label)
-            #report dice lesional
-            dice.append(dices[1])
-            #get sensitivity
-            label2= torch.as_tensor(np.array(subj['borderzone'].astype(bool))).long()
-            tp, fp, fn, tn = tp_fp_fn_tn(mask, label2)   
-                
-            if sum(subj['input_labels']) != 0:
-                patient_sens.append(tp > 1)
-            else:
-                control_spec.append(fp >1 )
-        return np.mean(dice), np.mean(patient_sens), 1-np.mean(control_spec)
+        # all subjects have the same number of cortex vertices, so subjects are stacked as rows
+        subjects = list(subjects_dict.values())[: len(thresholds)]
+        thresholds = np.asarray(thresholds)[: len(subjects)]
+        predicted = np.stack([subj['result'] for subj in subjects]) >= thresholds[:, None]
+        labels = np.stack([subj['input_labels'] for subj in subjects]).astype(bool)
+        borderzone = np.stack([subj['borderzone'] for subj in subjects]).astype(bool)
+        #report dice lesional, same smoothing as dice_coeff
+        tp = np.logical_and(predicted, labels).sum(axis=1)
+        fp = np.logical_and(predicted, ~labels).sum(axis=1)
+        fn = np.logical_and(~predicted, labels).sum(axis=1)
+        dice = (2 * tp + 1e-15) / (2 * tp + fp + fn + 1e-15)
+        #get sensitivity
+        tp_borderzone = np.logical_and(predicted, borderzone).sum(axis=1)
+        fp_borderzone = np.logical_and(predicted, ~borderzone).sum(axis=1)
+        is_patient = labels.any(axis=1)
+        n_patients = np.count_nonzero(is_patient)
+        # count detected patients and controls with false positives as integers instead of averaging booleans
+        patient_sens = np.count_nonzero(tp_borderzone[is_patient] > 1) / n_patients
+        control_spec = np.count_nonzero(fp_borderzone[~is_patient] > 1) / (len(is_patient) - n_patients)
+        return np.mean(dice), patient_sens, 1-control_spec
+
+def confusion_counts(pred, target):
+    """
+    Returns TP, FP, FN, TN of boolean numpy arrays, counted in a single pass.
+    """
+    # encode each vertex as 2*pred + target: 0=TN, 1=FN, 2=FP, 3=TP
+    code = (pred.astype(np.uint8) << 1) | target.astype(np.uint8)
+    tn, fn, fp, tp = np.bincount(code, minlength=4)
+    return tp, fp, fn, tn
+
+def dice_from_confusion(tp, fp, fn, tn, smooth=1e-15):
+    """
+    Returns dice of the lesional and of the non-lesional class of binary masks from their confusion counts.
+    Uses the same smoothing as dice_coeff.
+    """
+    tp, fp, fn, tn = int(tp), int(fp), int(fn), int(tn)
+    dice_lesion = (2 * tp + smooth) / (2 * tp + fp + fn + smooth)
+    dice_non_lesion = (2 * tn + smooth) / (2 * tn + fp + fn + smooth)
+    return dice_lesion, dice_non_lesion
+
+def roc_auc(y_true, y_score):
+    """
+    Area under the roc curve of boolean labels y_true, computed from the rank sum of the positives
+    (Mann-Whitney U statistic). Gives the same result as sklearn.metrics.roc_auc_score.
+    """
+    y_true = np.asarray(y_true, dtype=bool)
+    n_pos = y_true.sum()
+    n_neg = len(y_true) - n_pos
+    # tied scores get their average rank
+    ranks = scipy.stats.rankdata(y_score)
+    return (ranks[y_true].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """
+    Exclusive lock shared by all processes using filename, held on the file filename.lock.
+    Waits until the lock is available. The lock file is removed when the lock is released.
+    Without fcntl (windows), does not lock.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_filename = f"{filename}.lock"
+    while True:
+        lock_file = open(lock_filename, "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # the previous holder may have removed the lock file while we were waiting, then the lock is stale
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_filename)):
+                break
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+    try:
+        yield
+    finally:
+        # remove the lock file before releasing the lock, so that waiting processes retry with a new file
+        os.remove(lock_filename)
+        lock_file.close()
+
+def prefetch_to_device(data_loader, device):
+    """
+    Iterate over data_loader, moving each batch to device.
+    On cuda, the next batch is copied on a separate stream while the current batch is processed.
+    """
+    if device.type != "cuda":
+        for data in data_loader:
+            yield data.to(device)
+        return
+    copy_stream = torch.cuda.Stream(device)
+    compute_stream = torch.cuda.current_stream(device)
+    current = None
+    for data in data_loader:
+        with torch.cuda.stream(copy_stream):
+            data = data.to(device, non_blocking=True)
+        if current is not None:
+            yield current
+        # batch is only used once its copy finished, and its memory is not reused while in use on compute_stream
+        compute_stream.wait_stream(copy_stream)
+        for _, value in data:
+            if torch.is_tensor(value):
+                value.record_stream(compute_stream)
+        current = data
+    if current is not None:
+        yield current
 
 def sigmoid(x, k=2, m=0.5, ymin=0.03, ymax=0.5):
     """
@@ -1118,21 +1335,22 @@ def sigmoid(x, k=2, m=0.5, ymin=0.03, ymax=0.5):
         ymin: min value
         ymax: max value
     """
+    x = np.asarray(x, dtype=float)
     xmax = m*2
+    # position of x in the range 0,xmax
+    t = np.clip(x / xmax, 0, 1)
     # inverse sigmoid function with fixed endpoints and variable slope k
-    # k = 0 defaults to ymin
-    if k == 0:
-        return np.ones_like(x)*ymin
-    eps = 1e-15
-    res = 1 / (1 + (1/(x/xmax+eps)-1)**(-k))
-    # scale y range
-    scaled_res = res * (ymax - ymin) + ymin
+    # update intermediate arrays in place to avoid allocating a temporary per operation
+    res = np.asarray((1 - t)**k)
+    res /= res + t**k
+    # scale y range, clip values to be ymax at max
+    res *= ymax - ymin
+    res += ymin
+    scaled_res = np.minimum(res, ymax, out=res)
     # clip values of x > xmax to ymin
-    scaled_res[x > xmax] = ymin
-
-    # clip values to be ymax at max
-    scaled_res[scaled_res > ymax] = ymax
-    return scaled_res
+    np.copyto(scaled_res, ymin, where=x > xmax)
+    # k = 0 defaults to ymin
+    return np.where(np.asarray(k) == 0, ymin, scaled_res)
 
 def save_json(json_filename, json_results):
     """
@@ -1143,34 +1361,60 @@ def save_json(json_filename, json_results):
     return
 
 
-def create_surface_plots(coords, faces, overlay, flat_map=True, limits=None):
-    """plot and reload surface images"""
-    from meld_graph.meld_plotting import trim
-    import matplotlib_surface_plotting.matplotlib_surface_plotting as msp
-    from PIL import Image
+@functools.lru_cache(maxsize=2)
+def get_surface_mesh(flat_map=True):
+    """coords and faces of the flat map, or of the icosphere if flat_map is False. Loaded once per process."""
+    if not flat_map:
+        ico_ini = shared_icospheres().icospheres[7]
+        return ico_ini["coords"], ico_ini["faces"]
+    flat = nb.load(os.path.join(MELD_PARAMS_PATH, "fsaverage_sym", "surf", "lh.full.patch.flat.gii"))
+    return flat.darrays[0].data, flat.darrays[1].data
+
+
+# surface mesh and flat_map setting of a surface plotting worker process, set by _init_surface_plot_worker
+_worker_surface = None
+
+
+def _init_surface_plot_worker(flat_map):
+    """load the surface mesh once in each plotting worker process"""
+    global _worker_surface
+    _worker_surface = get_surface_mesh(flat_map), flat_map
+
+
+def _create_surface_plot_in_worker(overlay):
+    """create_surface_plots on the mesh of this plotting worker process"""
+    (coords, faces), flat_map = _worker_surface
+    return create_surface_plots(coords, faces, overlay, flat_map=flat_map)
+
 
+def create_surface_plots(coords, faces, overlay, flat_map=True, limits=None):
+    """plot surface images and return them as RGBA array"""
     if limits == None:
         vmin = np.min(overlay)
         vmax = np.max(overlay)
     else:
         vmin = limits[0]
         vmax = limits[1]
-    tmp_file = os.path.join(MELD_DATA_PATH,'tmp.png')
-    msp.plot_surf(
+    fig, _, _ = msp.plot_surf(
         coords,
         faces,
         overlay,
         flat_map=flat_map,
         rotate=[90, 270],
-        filename=tmp_file,
+        filename=None,
         vmin=vmin,
         vmax=vmax,
+        return_ax=True,
     )
-    im = Image.open(tmp_file)
+    # render the figure to an RGBA array directly, with transparent background as when saving the plot
+    fig.patch.set_alpha(0)
+    for ax in fig.axes:
+        ax.patch.set_alpha(0)
+    fig.canvas.draw()
+    im = Image.fromarray(np.asarray(fig.canvas.buffer_rgba()))
+    plt.close(fig)
     im = trim(im)
-    im = im.convert("RGBA")
     im1 = np.array(im)
-    os.remove(tmp_file)
     return im1
 
 
@@ -1192,24 +1436,84 @@ def plot_roc_multiple(roc_dictionary, roc_curves_thresholds):
     return fig
 
 
+@contextlib.contextmanager
+def open_predictions_for_reading(hdf5):
+    """
+    open predictions file read-only, to load several subjects with load_prediction without reopening the file.
+    Processes cannot open the file for writing while it is open, so keep the context as short as possible.
+    """
+    with h5py.File(hdf5, "r", rdcc_nbytes=PREDICTION_CHUNK_CACHE_NBYTES, rdcc_nslots=PREDICTION_CHUNK_CACHE_NSLOTS) as f:
+        yield f
+
+
 def load_prediction(subject, hdf5, dset="prediction"):
-    """load network predictions"""
+    """
+    load network predictions.
+    hdf5 is the path of the predictions file, or a file opened with open_predictions_for_reading.
+    """
+    if not isinstance(hdf5, h5py.File):
+        with open_predictions_for_reading(hdf5) as f:
+            return load_prediction(subject, f, dset=dset)
     results = {}
-    with h5py.File(hdf5, "r") as f:
-        for hemi in ["lh", "rh"]:
-            results[hemi] = f[subject][hemi][dset][:]
+    for hemi in ["lh", "rh"]:
+        results[hemi] = hdf5[subject][hemi][dset][:]
     return results
 
 
 def roc_curves(subject_dictionary, roc_dictionary, roc_curves_thresholds):
     """calculate performance at multiple thresholds"""
-    for t_i, threshold in enumerate(roc_curves_thresholds):
-        predicted = subject_dictionary["result"] >= threshold
-        # if we want tpr vs fpr curve too
-        # store sensitivity and sensitivity_plus for each patient (has a label)
-        if subject_dictionary["input_labels"].sum() > 0:
-            roc_dictionary["sensitivity"][t_i] += np.logical_and(predicted, subject_dictionary["input_labels"]).any()
-            roc_dictionary["sensitivity_plus"][t_i] += np.logical_and(predicted, subject_dictionary["borderzone"]).any()
-        # store specificity for controls (no label)
-        else:
-            roc_dictionary["specificity"][t_i] += ~predicted.any()
+    # a mask contains a prediction >= threshold exactly if its maximum prediction is >= threshold,
+    # so all thresholds are evaluated with one pass over the predictions
+    thresholds = np.asarray(roc_curves_thresholds)
+    result = subject_dictionary["result"]
+    # store sensitivity and sensitivity_plus for each patient (has a label)
+    if subject_dictionary["input_labels"].any():
+        roc_dictionary["sensitivity"] += masked_max(result, subject_dictionary["input_labels"]) >= thresholds
+        roc_dictionary["sensitivity_plus"] += masked_max(result, subject_dictionary["borderzone"]) >= thresholds
+    # store specificity for controls (no label)
+    else:
+        roc_dictionary["specificity"] += result.max() < thresholds
+
+
+def masked_max(values, mask):
+    """maximum of values inside mask, -inf for an empty mask"""
+    return np.max(values, where=mask.astype(bool), initial=-np.inf)
+
+
+def masked_max_torch(values, mask):
+    """maximum of tensor values inside boolean mask, -inf for an empty mask"""
+    return torch.where(mask, values, values.new_tensor(-np.inf)).max()
+
+
+def cluster_saliencies(saliency_model, inputs, masks, max_clusters_per_batch=4):
+    """
+    Integrated gradients of the mean lesion prediction in each cluster with respect to inputs.
+    saliency_model is IntegratedGradients(PredictionForSaliency(model)), masks has shape (n_clusters, n_vertices).
+    max_clusters_per_batch copies of inputs, one per cluster, are attributed together.
+    Returns array of shape (n_clusters,) + inputs.shape.
+    """
+    saliencies = []
+    for start in range(0, len(masks), max_clusters_per_batch):
+        batch_masks = masks[start : start + max_clusters_per_batch]
+        batch_inputs = inputs.repeat(len(batch_masks), 1)
+        batch_saliencies = saliency_model.attribute(batch_inputs, additional_forward_args=batch_masks, target=1, n_steps=25,
+                                    method='gausslegendre', internal_batch_size=len(batch_inputs))
+        saliencies.append(batch_saliencies.reshape((len(batch_masks),) + tuple(inputs.shape)).cpu().numpy())
+    return np.concatenate(saliencies)
+
+
+def predict_mc_dropout(model, x, dropout_p, dropout_n, batch_size):
+    """
+    Mean lesion prediction and distance map over dropout_n samples of x, each value of x kept with probability dropout_p.
+    batch_size samples are stacked and predicted in one forward pass.
+    """
+    prediction = torch.zeros(len(x), device=x.device)
+    distance_map = torch.zeros(len(x), device=x.device)
+    for start in range(0, dropout_n, batch_size):
+        n_samples = min(batch_size, dropout_n - start)
+        keep = torch.bernoulli(torch.full((n_samples,) + tuple(x.shape), dropout_p, device=x.device)).bool()
+        x_samples = torch.where(keep, x.unsqueeze(0), torch.zeros((), device=x.device))
+        estimates = model(x_samples.reshape(-1, x.shape[1]))
+        prediction += torch.exp(estimates["log_softmax"])[:, 1].reshape(n_samples, -1).sum(dim=0)
+        distance_map += estimates["non_lesion_logits"][:, 0].reshape(n_samples, -1).sum(dim=0)
+    return prediction / dropout_n, distance_map / dropout_n
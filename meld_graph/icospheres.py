@@ -1,4 +1,5 @@
 import os
+import functools
 import numpy as np
 import nibabel as nb
 from scipy import sparse
@@ -330,3 +331,14 @@ class IcoSpheres:
             old_neighbours = new_neighbours
 
         return np.array(spiral[:size])
+
+
+@functools.lru_cache(maxsize=None)
+def shared_icospheres(icosphere_path="data/icospheres/", distance_type="pseudo", conv_type="GMMConv"):
+    """
+    Return an IcoSpheres instance shared between all callers using the same arguments.
+
+    Use this where icospheres are only read (datasets, plotting), to avoid reloading all levels.
+    Models create their own IcoSpheres, as they move them to the device.
+    """
+    return IcoSpheres(icosphere_path=icosphere_path, distance_type=distance_type, conv_type=conv_type)
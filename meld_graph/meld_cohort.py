@@ -50,6 +50,8 @@ class MeldCohort:
         self._surf_area = None
         # adj_mat: sparse adjacency matrix for all vertices
         self._adj_mat = None
+        # adj_edges: source and target vertex of each edge in adj_mat
+        self._adj_edges = None
         # lobes: labels for cortical lobes
         self._lobes = None
         # neighbours: list of neighbours for each vertex
@@ -120,6 +122,14 @@ class MeldCohort:
             ).tocsr()
         return self._adj_mat
 
+    @property
+    def adj_edges(self):
+        if self._adj_edges is None:
+            adj_mat = self.adj_mat
+            rows = np.repeat(np.arange(adj_mat.shape[0]), np.diff(adj_mat.indptr))
+            self._adj_edges = (rows, adj_mat.indices)
+        return self._adj_edges
+
     @property
     def neighbours(self):
         if self._neighbours is None:
@@ -372,6 +382,19 @@ class MeldCohort:
             hemisphere_data[hemi] = feature_data
         return hemisphere_data
 
+    def combine_hemispheres(self, left, right):
+        """
+        inverse of split_hemispheres: gather cortex vertices of two full overlays
+        into one cortex-masked vector (left followed by right).
+        """
+        left = np.asarray(left)
+        right = np.asarray(right)
+        n_cortex = len(self.cortex_label)
+        combined = np.empty((2 * n_cortex,) + left.shape[1:], dtype=np.result_type(left, right))
+        np.take(left, self.cortex_label, axis=0, out=combined[:n_cortex])
+        np.take(right, self.cortex_label, axis=0, out=combined[n_cortex:])
+        return combined
+
 
 class MeldSubject:
     """
@@ -571,16 +594,13 @@ class MeldSubject:
             feature_data, label
 
         """
-        # load all features
-        feature_values = []
-        for feature in features:
-            if feature in features_to_ignore:
-                # append zeros for features_to_ignore
-                feature_values.append(np.zeros(NVERT, dtype=np.float32))
-            else:
+        # load all features into a preallocated (vertices, features) array
+        # features_to_ignore are left as zeros
+        feature_values = np.zeros((NVERT, len(features)), dtype=np.float32)
+        for fi, feature in enumerate(features):
+            if feature not in features_to_ignore:
                 # read feature_values
-                feature_values.append(self.load_feature_values(feature, hemi=hemi))
-        feature_values = np.stack(feature_values, axis=-1)
+                feature_values[:, fi] = self.load_feature_values(feature, hemi=hemi)
         # load lesion data
         lesion_values = np.ceil(self.load_feature_values(".on_lh.lesion.mgh", hemi=hemi)).astype(int)
 
@@ -594,17 +614,16 @@ class MeldSubject:
                        30 for training exclusion, 20 for sensitivity testing
         """
         cortex_mask = self.cohort.cortex_mask
-        boundary_zones = np.zeros(2 * sum(cortex_mask)).astype(float)
+        n_cortex = len(self.cohort.cortex_label)
+        boundary_zones = np.zeros(2 * n_cortex).astype(float)
         hemi = self.get_lesion_hemisphere()
         for k, h in enumerate(["lh", "rh"]):
+            # non-lesional hemisphere stays zero
             if hemi == h:
                 bz = self.load_feature_values(feat_name, hemi=hemi)
                 if max_distance is not None:
                     bz = bz < max_distance
-                boundary_zones[k * sum(cortex_mask) : (k + 1) * sum(cortex_mask)] = bz[cortex_mask]
-            else:
-                bz = np.zeros(len(cortex_mask))
-                boundary_zones[k * sum(cortex_mask) : (k + 1) * sum(cortex_mask)] = bz[cortex_mask]
+                boundary_zones[k * n_cortex : (k + 1) * n_cortex] = bz[cortex_mask]
 
         return boundary_zones
 
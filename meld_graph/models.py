@@ -356,7 +356,6 @@ class MoNetUnet(nn.Module):
         original_shape = batch_x.shape
 
         batch_x = batch_x.view((batch_x.shape[0] // self.n_vertices, self.n_vertices, self.num_features))
-        skip_connections = []
         outputs = {"log_softmax": [], "non_lesion_logits": [], "log_sumexp": []}
         for level in self.deep_supervision:
             outputs[f"ds{level}_log_softmax"] = []
@@ -368,6 +367,8 @@ class MoNetUnet(nn.Module):
             outputs['object_detection_linear'] = []
         for x in batch_x:
             level = 7
+            # skip connections of this sample only, the decoder indexes them per level
+            skip_connections = []
             for i, block in enumerate(self.encoder_conv_layers):
                 for cl in block:
                     x = cl(x, device=self.device)
@@ -531,6 +532,13 @@ class PredictionForSaliency(nn.Module):
         prediction = torch.exp(self.model(input)['log_softmax'])
         if mask is None:
             prediction = torch.mean(prediction, axis=0)
+        elif mask.ndim == 2:
+            # input is a batch of samples, each sample is paired with one of the masks (n_masks, n_vertices)
+            mask = torch.as_tensor(mask, device=prediction.device)
+            prediction = prediction.reshape(-1, mask.shape[1], prediction.shape[-1])
+            mask = mask.repeat(len(prediction) // len(mask), 1).to(prediction.dtype)
+            # return shape is (n_samples,2)
+            return (prediction * mask[:, :, None]).sum(axis=1) / mask.sum(axis=1, keepdim=True)
         else:
             prediction = torch.mean(prediction[mask], axis=0)
         # return shape is (1,2)
@@ -2,13 +2,18 @@
 # tested functions:
 #   load_combined_hemisphere_data
 #   Dataset - behaviour with different flags, active selection
+#   Oversampler - samples every lesional index and random indices in range
+#   GraphDataset.pack_tensors - packed tensors match data returned without packing
+#   GraphDataset lazy_loading - cached data matches in-memory data, cache directory is removed with the dataset
 # NOTE:
 #   these tests require a test dataset, that is created with get_test_data()
 #   executing this function may take a while the first time (while the test data is being created)
 # MISSING TESTS:
 #   Dataset - test asserting correct handling of boundary zones in Dataset
 
-from meld_graph.dataset import GraphDataset
+import gc
+import os
+from meld_graph.dataset import GraphDataset, Oversampler
 from meld_graph.download_data import get_test_data
 from meld_graph.meld_cohort import MeldSubject, MeldCohort
 import pytest
@@ -16,6 +21,7 @@ from meld_graph.paths import NVERT, DEFAULT_HDF5_FILE_ROOT
 # from meld_graph.network_tools import build_model
 from meld_graph.test.utils import create_test_demos
 import numpy as np
+import torch
 from copy import deepcopy
 
 
@@ -90,4 +96,97 @@ def test_dataset_flags(data_parameters):
         i=i+1
         assert (data.x.shape[1]==len(features_list))
         assert (data.x.shape[0]==NVERT)
-    assert i==len(subject_ids*2)
\ No newline at end of file
+    assert i==len(subject_ids*2)
+
+
+def create_val_datasets(data_parameters, tmp_path, output_levels=[5, 6]):
+    """create the same validation dataset in memory and with lazy loading"""
+    create_test_demos()
+    c = MeldCohort(hdf5_file_root=data_parameters["hdf5_file_root"], dataset='/tmp/dataset_test.csv')
+    subject_ids = c.get_subject_ids(**data_parameters)[0:5]
+    features_list = c.get_features(features_to_exclude=data_parameters["features_to_exclude"])
+    cur_data_params = dict(data_parameters, features=features_list)
+    dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val", output_levels=output_levels)
+    lazy_params = dict(cur_data_params, lazy_loading=True, cache_dir=str(tmp_path))
+    lazy_dataset = GraphDataset(subject_ids, cohort=c, params=lazy_params, mode="val", output_levels=output_levels)
+    return dataset, lazy_dataset
+
+
+def test_pack_tensors(data_parameters, tmp_path):
+    dataset, lazy_dataset = create_val_datasets(data_parameters, tmp_path)
+    # without augmentation, tensors are created once and packed
+    assert dataset.tensor_list is not None
+    assert lazy_dataset.tensor_list is None
+    x_0, y_0, distance_map_0, _ = dataset.tensor_list[0]
+    for i in range(len(dataset)):
+        x, y, distance_map, output_levels = dataset.tensor_list[i]
+        # entries are views into one packed tensor each
+        assert x.storage().data_ptr() == x_0.storage().data_ptr()
+        assert y.storage().data_ptr() == y_0.storage().data_ptr()
+        assert distance_map.storage().data_ptr() == distance_map_0.storage().data_ptr()
+        for key, value in output_levels.items():
+            if key.endswith("_distance_map"):
+                assert value.storage().data_ptr() == distance_map_0.storage().data_ptr()
+        # data matches data created from the unpacked arrays
+        data = dataset.get(i)
+        expected = lazy_dataset.get(i)
+        assert torch.equal(data.x, expected.x)
+        assert torch.equal(data.y, expected.y)
+        assert torch.equal(data.distance_map, expected.distance_map)
+        for level in dataset.output_levels:
+            assert torch.equal(getattr(data, f"output_level{level}"), getattr(expected, f"output_level{level}"))
+            assert torch.equal(
+                getattr(data, f"output_level{level}_distance_map"),
+                getattr(expected, f"output_level{level}_distance_map"),
+            )
+        assert np.array_equal(dataset.data_list[i]["distances"], expected.distance_map.numpy())
+
+
+class DataSourceStub:
+    """minimal data source with lesional_idxs, as used by Oversampler"""
+
+    def __init__(self, n, lesional_idxs):
+        self.n = n
+        self.lesional_idxs = lesional_idxs
+
+    def __len__(self):
+        return self.n
+
+
+def test_oversampler_sampling():
+    data_source = DataSourceStub(100, [3, 17, 42, 99])
+    sampler = Oversampler(data_source)
+    assert sampler.num_samples == 12
+    for _ in range(10):
+        ids = list(sampler)
+        assert len(ids) == sampler.num_samples
+        assert all(isinstance(i, int) for i in ids)
+        assert all(0 <= i < len(data_source) for i in ids)
+        # every lesional index is sampled at least once per epoch
+        assert set(data_source.lesional_idxs) <= set(ids)
+
+
+def test_oversampler_no_lesions():
+    with pytest.raises(ValueError):
+        Oversampler(DataSourceStub(100, []))
+
+
+def test_lazy_loading(data_parameters, tmp_path):
+    dataset, lazy_dataset = create_val_datasets(data_parameters, tmp_path, output_levels=[])
+    # data is cached in a new directory inside cache_dir
+    cache_dir = lazy_dataset.cache_dir
+    assert os.path.dirname(cache_dir) == str(tmp_path)
+    assert os.path.basename(cache_dir).startswith("meld_graph_val_")
+    assert len(os.listdir(cache_dir)) > 0
+    assert len(lazy_dataset) == len(dataset)
+    for i in range(len(dataset)):
+        assert all(os.path.isfile(path) for path in lazy_dataset.data_list[i].values())
+        data = dataset.get(i)
+        expected = lazy_dataset.get(i)
+        assert torch.equal(data.x, expected.x)
+        assert torch.equal(data.y, expected.y)
+        assert torch.equal(data.distance_map, expected.distance_map)
+    # cache directory is removed when the dataset is deleted
+    del lazy_dataset, expected
+    gc.collect()
+    assert not os.path.exists(cache_dir)
@@ -0,0 +1,175 @@
+#### tests for evaluation.py helper functions ####
+# tested functions:
+#   roc_auc - matches sklearn roc_auc_score
+#   confusion_counts, dice_from_confusion - match elementwise counts and dice_coeff
+#   sigmoid - matches the original implementation
+#   Evaluator.cluster_and_area_threshold - matches clustering on the sliced adjacency matrix,
+#       with minimum area thresholds and island numbering
+#   Evaluator._write_prediction, Evaluator._read_prediction, load_prediction, open_predictions_for_reading -
+#       predictions are read back as written
+# NOTE:
+#   these tests use synthetic data and do not require the test dataset
+
+import logging
+from types import SimpleNamespace
+import h5py
+import numpy as np
+import pytest
+import scipy.sparse.csgraph
+import sklearn.metrics
+import torch
+from meld_graph.evaluation import (
+    Evaluator,
+    confusion_counts,
+    dice_from_confusion,
+    load_prediction,
+    open_predictions_for_reading,
+    roc_auc,
+    sigmoid,
+)
+from meld_graph.meld_cohort import MeldCohort
+from meld_graph.training import dice_coeff
+
+
+def sigmoid_reference(x, k=2, m=0.5, ymin=0.03, ymax=0.5):
+    """original implementation of sigmoid"""
+    xmax = m * 2
+    if k == 0:
+        return np.ones_like(x) * ymin
+    eps = 1e-15
+    res = 1 / (1 + (1 / (x / xmax + eps) - 1) ** (-k))
+    scaled_res = res * (ymax - ymin) + ymin
+    scaled_res[x > xmax] = ymin
+    scaled_res[scaled_res > ymax] = ymax
+    return scaled_res
+
+
+def cluster_and_area_threshold_reference(adj_mat, mask, island_count=0, min_area_threshold=0):
+    """original implementation of Evaluator.cluster_and_area_threshold"""
+    n_comp, labels = scipy.sparse.csgraph.connected_components(adj_mat[mask][:, mask])
+    islands = np.zeros(len(mask))
+    for island_index in np.arange(n_comp):
+        include_vec = labels == island_index
+        size = np.sum(include_vec)
+        if size >= min_area_threshold:
+            island_count += 1
+            island_mask = mask.copy()
+            island_mask[mask] = include_vec
+            islands[island_mask] = island_count
+    return islands
+
+
+@pytest.fixture
+def grid_cohort():
+    """cohort on a triangulated 20x20 grid mesh"""
+    n = 20
+    idx = np.arange(n * n).reshape(n, n)
+    faces = np.concatenate(
+        [
+            np.stack([idx[:-1, :-1].ravel(), idx[1:, :-1].ravel(), idx[:-1, 1:].ravel()], axis=1),
+            np.stack([idx[1:, :-1].ravel(), idx[1:, 1:].ravel(), idx[:-1, 1:].ravel()], axis=1),
+        ]
+    )
+    coords = np.stack([idx.ravel() // n, idx.ravel() % n, np.zeros(n * n)], axis=1)
+    cohort = MeldCohort()
+    cohort._surf = {"coords": coords, "faces": faces}
+    return cohort
+
+
+def cluster(cohort, mask, **kwargs):
+    """call Evaluator.cluster_and_area_threshold with an evaluator using cohort"""
+    evaluator = SimpleNamespace(experiment=SimpleNamespace(cohort=cohort))
+    return Evaluator.cluster_and_area_threshold(evaluator, mask, **kwargs)
+
+
+@pytest.fixture
+def binary_masks():
+    rng = np.random.default_rng(0)
+    pred = rng.random(1000) > 0.8
+    target = rng.random(1000) > 0.9
+    return pred, target
+
+
+def test_roc_auc_matches_sklearn():
+    rng = np.random.default_rng(0)
+    y_true = rng.random(500) > 0.7
+    # rounded scores to include ties
+    y_score = np.round(rng.random(500) + 0.3 * y_true, 1)
+    assert np.isclose(roc_auc(y_true, y_score), sklearn.metrics.roc_auc_score(y_true, y_score))
+
+
+def test_confusion_counts(binary_masks):
+    pred, target = binary_masks
+    tp, fp, fn, tn = confusion_counts(pred, target)
+    assert tp == np.sum(pred & target)
+    assert fp == np.sum(pred & ~target)
+    assert fn == np.sum(~pred & target)
+    assert tn == np.sum(~pred & ~target)
+    assert tp + fp + fn + tn == len(pred)
+
+
+def test_dice_from_confusion_matches_dice_coeff(binary_masks):
+    pred, target = binary_masks
+    dice_lesion, dice_non_lesion = dice_from_confusion(*confusion_counts(pred, target))
+    expected = dice_coeff(
+        torch.nn.functional.one_hot(torch.as_tensor(pred).long(), num_classes=2), torch.as_tensor(target).long()
+    )
+    assert np.isclose(dice_lesion, expected[1].item())
+    assert np.isclose(dice_non_lesion, expected[0].item())
+
+
+@pytest.mark.parametrize("k", [0, 1, 2, 5])
+@pytest.mark.parametrize("m", [0.1, 0.25, 0.5])
+def test_sigmoid_matches_reference(k, m):
+    x = np.linspace(0, 1.5, 301)
+    assert np.allclose(sigmoid(x, k=k, m=m), sigmoid_reference(x, k=k, m=m))
+
+
+def test_adj_edges_match_adj_mat(grid_cohort):
+    rows, cols = grid_cohort.adj_edges
+    adj_coo = grid_cohort.adj_mat.tocoo()
+    assert np.array_equal(rows, adj_coo.row)
+    assert np.array_equal(cols, adj_coo.col)
+
+
+@pytest.mark.parametrize("density", [0.0, 0.3, 0.5, 0.7, 1.0])
+def test_cluster_and_area_threshold_matches_reference(grid_cohort, density):
+    rng = np.random.default_rng(0)
+    mask = rng.random(len(grid_cohort.surf["coords"])) < density
+    islands = cluster(grid_cohort, mask)
+    expected = cluster_and_area_threshold_reference(grid_cohort.adj_mat, mask)
+    assert np.array_equal(islands, expected)
+
+
+@pytest.mark.parametrize("min_area_threshold, island_count", [(1, 0), (5, 0), (5, 3), (50, 2), (1000, 0)])
+def test_cluster_and_area_threshold_min_area(grid_cohort, min_area_threshold, island_count):
+    rng = np.random.default_rng(1)
+    mask = rng.random(len(grid_cohort.surf["coords"])) < 0.45
+    islands = cluster(grid_cohort, mask, island_count=island_count, min_area_threshold=min_area_threshold)
+    expected = cluster_and_area_threshold_reference(
+        grid_cohort.adj_mat, mask, island_count=island_count, min_area_threshold=min_area_threshold
+    )
+    assert np.array_equal(islands, expected)
+    # kept islands are numbered consecutively after island_count
+    ids = np.unique(islands[islands > 0])
+    assert np.array_equal(ids, np.arange(island_count + 1, island_count + 1 + len(ids)))
+
+
+def test_prediction_write_read_round_trip(tmp_path):
+    nvert_hemi = 100
+    prediction = np.random.default_rng(0).random(2 * nvert_hemi).astype(np.float32)
+    evaluator = SimpleNamespace(log=logging.getLogger(__name__))
+    filename = tmp_path / "predictions.hdf5"
+    with h5py.File(filename, "a") as f:
+        Evaluator._write_prediction(evaluator, f, "subj", prediction, "prediction", np.float32, nvert_hemi)
+    with h5py.File(filename, "r") as f:
+        result = Evaluator._read_prediction(evaluator, f, "subj", "prediction")
+        assert Evaluator._read_prediction(evaluator, f, "missing", "prediction") is None
+    assert result.dtype == np.float32
+    assert np.array_equal(result, prediction)
+    # module level loading, from path and from open file
+    with open_predictions_for_reading(filename) as f:
+        results = [load_prediction("subj", filename), load_prediction("subj", f)]
+    for result in results:
+        assert np.array_equal(result["lh"], prediction[:nvert_hemi])
+        assert np.array_equal(result["rh"], prediction[nvert_hemi:])
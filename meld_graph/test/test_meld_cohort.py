@@ -4,6 +4,7 @@
 #   get_subject_ids
 #   get_sites
 #   split_hemispheres
+#   combine_hemispheres
 #   cortex_label attribute
 # NOTE:
 #   these tests require a test dataset, that is created with get_test_data()
@@ -186,3 +187,19 @@ def test_split_hemispheres():
     input_data = np.zeros(100)
     with pytest.raises(AssertionError):
         c.split_hemispheres(input_data)
+
+
+def test_combine_hemispheres():
+    c = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT, dataset='/tmp/dataset_test.csv')
+    rng = np.random.default_rng(0)
+    # combine_hemispheres is the inverse of split_hemispheres, also for per-vertex features
+    for shape in [(2 * len(c.cortex_label),), (2 * len(c.cortex_label), 3)]:
+        input_data = rng.random(shape)
+        hemi_data = c.split_hemispheres(input_data)
+        combined = c.combine_hemispheres(hemi_data["left"], hemi_data["right"])
+        assert np.array_equal(combined, input_data)
+    # matches gathering the cortex of each hemisphere with the cortex mask
+    left = rng.random((NVERT, 3))
+    right = rng.random((NVERT, 3))
+    expected = np.vstack([left[c.cortex_mask], right[c.cortex_mask]])
+    assert np.array_equal(c.combine_hemispheres(left, right), expected)
@@ -0,0 +1,93 @@
+#### tests for models.py and batched model predictions in evaluation.py ####
+# tested functions:
+#   MoNetUnet.forward - batched forward pass matches forward passes of single hemispheres
+#   predict_mc_dropout - batched dropout samples match predicting one sample at a time
+#   cluster_saliencies, PredictionForSaliency - batched saliency of several clusters matches one cluster at a time
+# NOTE:
+#   these tests use a small randomly initialised model and require the icospheres in data/icospheres
+
+import numpy as np
+import pytest
+import torch
+from meld_graph.evaluation import cluster_saliencies, predict_mc_dropout
+from meld_graph.models import MoNetUnet, PredictionForSaliency
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    model = MoNetUnet(
+        num_features=3,
+        layer_sizes=[[4], [4]],
+        icosphere_params={"icosphere_path": "data/icospheres/", "conv_type": "SpiralConv"},
+        conv_type="SpiralConv",
+        deep_supervision=[6],
+        distance_head=True,
+    )
+    model.to(torch.device("cpu"))
+    model.eval()
+    return model
+
+
+def test_batched_forward_matches_single_hemispheres(model):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.rand(2 * model.n_vertices, model.num_features, generator=generator)
+    with torch.no_grad():
+        batched = model(x)
+        single = [model(x_hemi) for x_hemi in x.split(model.n_vertices)]
+    for key, output in batched.items():
+        expected = torch.cat([s[key] for s in single])
+        assert torch.allclose(output, expected, atol=1e-6), key
+
+
+def predict_mc_dropout_reference(model, x, dropout_p, dropout_n, batch_size):
+    """predict the dropout samples of predict_mc_dropout one sample and hemisphere at a time"""
+    predictions = []
+    distance_maps = []
+    for start in range(0, dropout_n, batch_size):
+        n_samples = min(batch_size, dropout_n - start)
+        # draw the same masks as predict_mc_dropout
+        keep = torch.bernoulli(torch.full((n_samples,) + tuple(x.shape), dropout_p)).bool()
+        for keep_sample in keep:
+            x_sample = torch.where(keep_sample, x, torch.zeros(()))
+            # predict each hemisphere on its own
+            estimates = [model(x_hemi) for x_hemi in x_sample.split(model.n_vertices)]
+            predictions.append(torch.cat([torch.exp(e["log_softmax"])[:, 1] for e in estimates]))
+            distance_maps.append(torch.cat([e["non_lesion_logits"][:, 0] for e in estimates]))
+    return torch.stack(predictions).mean(axis=0), torch.stack(distance_maps).mean(axis=0)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3])
+def test_predict_mc_dropout_matches_single_samples(model, batch_size):
+    generator = torch.Generator().manual_seed(0)
+    # both hemispheres, as predicted in load_predict_data
+    x = torch.rand(2 * model.n_vertices, model.num_features, generator=generator)
+    with torch.no_grad():
+        torch.manual_seed(1)
+        prediction, distance_map = predict_mc_dropout(model, x, 0.8, 3, batch_size)
+        torch.manual_seed(1)
+        expected_prediction, expected_distance_map = predict_mc_dropout_reference(model, x, 0.8, 3, batch_size)
+    assert torch.allclose(prediction, expected_prediction, atol=1e-6)
+    assert torch.allclose(distance_map, expected_distance_map, atol=1e-5)
+
+
+@pytest.mark.parametrize("max_clusters_per_batch", [2, 3])
+def test_cluster_saliencies_match_single_clusters(model, max_clusters_per_batch):
+    captum_attr = pytest.importorskip("captum.attr")
+    saliency_model = captum_attr.IntegratedGradients(PredictionForSaliency(model))
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.rand(model.n_vertices, model.num_features, generator=generator)
+    # three clusters, that are not all attributed in the same batch for max_clusters_per_batch=2
+    clusters = np.zeros(model.n_vertices, dtype=int)
+    clusters[100:300] = 1
+    clusters[5000:5050] = 2
+    clusters[80000:81000] = 3
+    masks = clusters[None, :] == np.arange(1, 4)[:, None]
+    saliencies = cluster_saliencies(saliency_model, inputs, masks, max_clusters_per_batch=max_clusters_per_batch)
+    assert saliencies.shape == (3,) + tuple(inputs.shape)
+    for mask, saliency in zip(masks, saliencies):
+        # one cluster at a time, as calculated before batching clusters
+        expected = saliency_model.attribute(
+            inputs, additional_forward_args=mask, target=1, n_steps=25, method="gausslegendre", internal_batch_size=100
+        ).numpy()
+        assert np.allclose(saliency, expected, rtol=1e-4, atol=1e-7)
@@ -0,0 +1,28 @@
+#### tests for training.py ####
+# tested functions:
+#   dice_coeff_hard - matches dice_coeff on one-hot encoded predictions
+
+import pytest
+import torch
+from meld_graph.training import dice_coeff, dice_coeff_hard
+
+
+@pytest.mark.parametrize("soft_target", [False, True])
+def test_dice_coeff_hard_matches_one_hot_dice_coeff(soft_target):
+    generator = torch.Generator().manual_seed(0)
+    pred = (torch.rand(1000, generator=generator) > 0.8).long()
+    if soft_target:
+        target = torch.rand(1000, generator=generator)
+    else:
+        target = (torch.rand(1000, generator=generator) > 0.9).float()
+    expected = dice_coeff(torch.nn.functional.one_hot(pred, num_classes=2), target)
+    assert torch.allclose(dice_coeff_hard(pred, target), expected)
+
+
+def test_dice_coeff_hard_empty_prediction():
+    # no predicted and no labelled vertices gives perfect dice for both classes, as dice_coeff does
+    pred = torch.zeros(100, dtype=torch.long)
+    target = torch.zeros(100)
+    expected = dice_coeff(torch.nn.functional.one_hot(pred, num_classes=2), target)
+    assert torch.allclose(dice_coeff_hard(pred, target), expected)
+    assert torch.allclose(expected, torch.ones(2))
@@ -35,6 +35,30 @@ def dice_coeff(pred, target, smooth=1e-15):
     return dice
 
 
+def dice_coeff_hard(pred, target, smooth=1e-15):
+    """
+    Dice coefficient of hard class predictions, equivalent to dice_coeff on one-hot encoded pred.
+
+    Avoids one-hot encoding pred by computing the background terms from the lesion terms.
+
+    Args:
+        pred: tensor of predicted classes (0 or 1)
+        target: tensor of (soft) targets (not one-hot encoded)
+    """
+    pred = pred.to(target.dtype)
+    n = target.new_tensor(len(target))
+    pred_sum = pred.sum()
+    target_sum = target.sum()
+    intersection_lesion = (pred * target).sum()
+    target_sq_lesion = (target * target).sum()
+    # (1-pred)*(1-target) and (1-target)**2 expanded, pred is binary so pred*pred = pred
+    intersection = torch.stack((n - pred_sum - target_sum + intersection_lesion, intersection_lesion))
+    A_sum = torch.stack((n - pred_sum, pred_sum))
+    B_sum = torch.stack((n - 2 * target_sum + target_sq_lesion, target_sq_lesion))
+    dice = (2.0 * intersection + smooth) / (A_sum + B_sum + smooth)
+    return dice
+
+
 class DiceLoss(torch.nn.Module):
     """
     Dice loss.
@@ -337,7 +361,7 @@ class Metrics:
 
     def update(self, pred, target, pred_class, estimates, borderzone=None):
         if len(set(["dice_lesion", "dice_nonlesion"]).intersection(self.metrics_to_track)) > 0:
-            dice_coeffs = dice_coeff(torch.nn.functional.one_hot(pred, num_classes=2), target)
+            dice_coeffs = dice_coeff_hard(pred, target)
             if "dice_lesion" in self.metrics_to_track:
                 self.running_scores["dice_lesion"].append(dice_coeffs[1].item())
             if "dice_nonlesion" in self.metrics_to_track:
@@ -93,7 +93,6 @@ if __name__ == "__main__":
     eva.threshold_and_cluster(save_prediction_suffix=suffix)
 
     # save dropout parameters in hdf5
-    filename = os.path.join(eva.save_dir, "results", f"predictions{suffix}{eva.dropout_suffix}.hdf5")
-    with h5py.File(filename, mode='r+') as f:
+    with eva.open_prediction_file(f"{suffix}{eva.dropout_suffix}") as f:
         f.attrs['dropout_p'] = args.p
         f.attrs['dropout_n'] = args.n
\ No newline at end of file
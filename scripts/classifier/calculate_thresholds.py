@@ -4,7 +4,7 @@ import h5py
 import matplotlib.pyplot as plt
 from meld_classifier.meld_cohort import MeldCohort,MeldSubject
 import sklearn.metrics as metrics
-from meld_graph.evaluation import load_prediction, sens_spec_curves, roc_curves, plot_roc_multiple
+from meld_graph.evaluation import load_prediction, open_predictions_for_reading, sens_spec_curves, roc_curves, plot_roc_multiple, masked_max
 import pandas as pd
 import itertools
 import seaborn as sns
@@ -31,17 +31,17 @@ def calculate_roc(model_path, pred_fname,cohort,thresholds):
     #
     save_dir = os.path.join(model_path, 'results_best_model')
     # get list of subjects
-    with h5py.File(os.path.join(save_dir, pred_fname), "r") as f:
+    with open_predictions_for_reading(os.path.join(save_dir, pred_fname)) as f:
         subjects = list(f.keys())
-    # load individual subject predictions over folds
-    for subj in subjects:
+        # load individual subject predictions over folds
+        for subj in subjects:
             subject_dictionary = load_predictions_for_subject(subj, save_dir, cohort,thresholds,
-                                 roc_dictionary, pred_fname=pred_fname)
+                                 roc_dictionary, pred_fname=pred_fname, pred_file=f)
     auc = calculate_aucs(roc_dictionary)
     return roc_dictionary, auc
 
 def load_predictions_for_subject(subj, save_dir, cohort,thresholds,
-                                 roc_dictionary, pred_fname='predictions.hdf'):
+                                 roc_dictionary, pred_fname='predictions.hdf', pred_file=None):
     """
     Load and ensemble subject data. Returns subject_dict with keys "input_labels", "borderzone", "result"
     
@@ -49,6 +49,7 @@ def load_predictions_for_subject(subj, save_dir, cohort,thresholds,
         subj: subject string
         save_dirs: list of models (folds) that should be loaded & ensembled
         cohort: MeldCohort
+        pred_file: predictions file opened with open_predictions_for_reading. If None, opens save_dir/pred_fname
     """
     s = MeldSubject(subj,cohort=cohort)
     
@@ -63,7 +64,8 @@ def load_predictions_for_subject(subj, save_dir, cohort,thresholds,
     labels = np.hstack([labels_hemis['lh'][cohort.cortex_mask],labels_hemis['rh'][cohort.cortex_mask]])
     borderzones = np.vstack([dists['lh'][cohort.cortex_mask,:],dists['rh'][cohort.cortex_mask,:]]).ravel()<20
     # load predictions
-    pred_file = os.path.join(save_dir, pred_fname)
+    if pred_file is None:
+        pred_file = os.path.join(save_dir, pred_fname)
     result_hemis = load_prediction(subj,pred_file, dset='prediction')
     subject_results = np.hstack([result_hemis['lh'],result_hemis['rh']])
     # build results dict
@@ -74,15 +76,14 @@ def load_predictions_for_subject(subj, save_dir, cohort,thresholds,
         
 def roc_curves(subject_dictionary, roc_dictionary, roc_curves_thresholds):
     """calculate performance at multiple thresholds"""
-    for t_i, threshold in enumerate(roc_curves_thresholds):
-        predicted = subject_dictionary["result"] >= threshold
-        # if we want tpr vs fpr curve too
-        # store sensitivity and sensitivity_plus for each patient (has a label)
-        if subject_dictionary["input_labels"].sum() > 0:
-            roc_dictionary["sensitivity_plus"][t_i] += np.logical_and(predicted, subject_dictionary["borderzone"]).any()
-        # store specificity for controls (no label)
-        else:
-            roc_dictionary["specificity"][t_i] += ~predicted.any()
+    # compare the maximum prediction in each mask with all thresholds at once
+    thresholds = np.asarray(roc_curves_thresholds)
+    # store sensitivity_plus for each patient (has a label)
+    if subject_dictionary["input_labels"].any():
+        roc_dictionary["sensitivity_plus"] += masked_max(subject_dictionary["result"], subject_dictionary["borderzone"]) >= thresholds
+    # store specificity for controls (no label)
+    else:
+        roc_dictionary["specificity"] += subject_dictionary["result"].max() < thresholds
 
 
 def calculate_aucs(roc_dictionary):
@@ -216,6 +216,10 @@ data_parameters = {
     "combine_hemis": None,
     # "smooth_labels": smooth lesion groundtruth labels to enable soft segmentation. Use this with SoftCrossEntropy.
     "smooth_labels": False,
+    # lazy_loading: save preprocessed data to cache_dir and memory-map it per sample, instead of keeping all subjects in memory.
+    # "cache_dir" (optional) defaults to the system temporary directory. Data is written to a meld_graph_<mode>_* directory
+    # that is removed at exit; directories of killed runs need to be deleted manually.
+    "lazy_loading": False,
     # WARNING: parameters below change the lesion prediction task
     # lobes: if True, train on predicting frontal lobe vs other instead of the lesion predicting task
     "lobes": False,